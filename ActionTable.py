@@ -0,0 +1,39 @@
+'''
+Action table.
+
+Gives every combined action (tuple) an integer id, which is the column of
+the action in the Q-table.  The policy works with ids and only converts
+back to the tuple when the command has to be sent.
+
+'''
+import itertools
+
+import numpy as np
+
+
+class ActionTable:
+    def __init__(self, actions):
+        self.actions = [tuple(a) for a in actions]
+        self.ids = {a: i for i, a in enumerate(self.actions)}
+        # One row per action, handy for vectorized code.
+        self.array = np.asarray(self.actions, dtype=np.float64)
+
+    @classmethod
+    def grid(cls, *axes):
+        # Cartesian product, last axis changes faster (like the nested list comprehensions).
+        return cls(itertools.product(*axes))
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __getitem__(self, actionid):
+        return self.actions[actionid]
+
+    def __iter__(self):
+        return iter(self.actions)
+
+    def id(self, action):
+        return self.ids[tuple(action)]
+
+    def random_id(self):
+        return np.random.randint(len(self.actions))
@@ -0,0 +1,149 @@
+'''
+asyncio Controller Runtime
+
+Runs the controllers of many tanks in one process and one event loop.
+Every tank has its own telemetry port (where the simulator sends the
+ModelRecords, 4601, 4602, ...) and its own command port (4501, 4502, ...).
+
+A policy is a function
+
+    policy(tank, myvalues, othervalues)
+
+that receives the records of its tank and of the enemy for one tick (the
+same tuples that the Controller classes use, index them with td) and returns
+(thrust, steering, turretdecl, turretbearing, command) or None to send
+nothing.  command is 0, 11 to fire or 13 to reset.
+
+    python AsyncRuntime.py 1 2
+
+'''
+import asyncio
+import sys
+import time
+
+from Protocol import ModelRecord, CommandOrder
+from TelemetryDictionary import telemetrydirs as td
+from TelemetryIngest import FrameAssembler
+from Command import CommandEncoder
+import Geometry
+
+
+class TankEndpoint(asyncio.DatagramProtocol):
+    def __init__(self, tank, policy, tanks=(1, 2)):
+        self.tank = tank
+        self.policy = policy
+        self.tanks = tuple(tanks)
+        self.assembler = FrameAssembler(self.tanks)
+
+        self.commandtransport = None
+        self.buffer = bytearray(CommandOrder.size)
+        CommandOrder.pack_into(self.buffer, 0, 0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1, 0, 0, 0, 0, 0.0, 0.0, 0.0, 0, False, 0)
+
+        self.lastreceived = time.monotonic()
+        self.frames = 0
+        self.commands = 0
+        self.invalid = 0
+        self.errors = 0
+
+    def datagram_received(self, data, addr):
+        if len(data) != ModelRecord.size:
+            self.invalid += 1
+            return
+        self.lastreceived = time.monotonic()
+        for frame in self.assembler.add((ModelRecord.struct.unpack(data),)):
+            self.step(frame)
+
+    def step(self, frame):
+        myvalues = frame[self.tank]
+        othervalues = next(frame[t] for t in self.tanks if t != self.tank)
+        self.frames += 1
+
+        try:
+            result = self.policy(self.tank, myvalues, othervalues)
+        except Exception as e:
+            # One bad policy must not stop the other tanks.
+            self.errors += 1
+            print('Tank %d policy error: %r' % (self.tank, e))
+            return
+        if result is None or self.commandtransport is None:
+            return
+
+        thrust, steering, turretdecl, turretbearing, command = result
+        CommandEncoder.head.pack_into(self.buffer, 0, self.tank, thrust, steering, turretdecl,
+                                      0.0, turretbearing, 0.0, 1, myvalues[td['timer']], command)
+        self.commandtransport.sendto(bytes(self.buffer))
+        self.commands += 1
+
+    def error_received(self, exc):
+        # ICMP port unreachable when the simulator is not listening.
+        pass
+
+
+class AsyncRuntime:
+    def __init__(self, ip='127.0.0.1', listenip='0.0.0.0', tanks=(1, 2)):
+        self.ip = ip
+        self.listenip = listenip
+        self.tanks = tuple(tanks)
+        self.specs = []
+        self.endpoints = {}
+        self.transports = []
+
+    def add_tank(self, tank, policy, telemetryport=None, commandport=None):
+        # Default ports are the ones of the simulator: 4600+tank and 4500+tank.
+        if telemetryport is None:
+            telemetryport = 4600 + tank
+        if commandport is None:
+            commandport = 4500 + tank
+        self.specs.append((tank, policy, telemetryport, commandport))
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for tank, policy, telemetryport, commandport in self.specs:
+            endpoint = TankEndpoint(tank, policy, self.tanks)
+            transport, _ = await loop.create_datagram_endpoint(lambda: endpoint, local_addr=(self.listenip, telemetryport))
+            commandtransport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(self.ip, commandport))
+            endpoint.commandtransport = commandtransport
+            self.endpoints[tank] = endpoint
+            self.transports += [transport, commandtransport]
+            print('Tank %d: telemetry on %s port %d, commands to %s port %d' % (tank, self.listenip, telemetryport, self.ip, commandport))
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    async def run(self, timeout=5, duration=None):
+        '''Runs until no tank received telemetry for timeout seconds (or for duration seconds).'''
+        await self.start()
+        started = time.monotonic()
+        try:
+            while True:
+                await asyncio.sleep(min(timeout, 1.0))
+                now = time.monotonic()
+                if duration is not None and now - started > duration:
+                    break
+                if all(now - e.lastreceived > timeout for e in self.endpoints.values()):
+                    print('Episode Completed')
+                    break
+        finally:
+            self.close()
+        return {tank: (e.frames, e.commands, e.assembler.dropped) for tank, e in self.endpoints.items()}
+
+
+def approach_policy(tank, myvalues, othervalues):
+    # Same idea as acercar_enemigo: turn to the enemy and go.
+    mybearing = float(myvalues[td['bearing']])
+    bearing = Geometry.bearing_to_scalar(float(myvalues[td['x']]), float(myvalues[td['z']]),
+                                         float(othervalues[td['x']]), float(othervalues[td['z']]))
+    thrust, steering = Geometry.approach_scalar(bearing, mybearing)
+    return thrust, steering, 0.0, Geometry.turret_bearing_scalar(bearing, mybearing), 0
+
+
+if __name__ == '__main__':
+    tanks = [int(t) for t in sys.argv[1:]] or [1, 2]
+    runtime = AsyncRuntime(tanks=tanks if len(tanks) > 1 else (1, 2))
+    for tank in tanks:
+        runtime.add_tank(tank, approach_policy)
+    stats = asyncio.run(runtime.run())
+    for tank, (frames, commands, dropped) in stats.items():
+        print('Tank %d: %d frames, %d commands, %d dropped frames' % (tank, frames, commands, dropped))
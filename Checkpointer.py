@@ -0,0 +1,156 @@
+'''
+Background Q-table checkpoints.
+
+save() is called from the control loop.  It only copies the rows that
+changed since the last call and wakes up the writer thread, so sending
+commands never waits for the disk.  Several save() calls that arrive while
+the writer is busy are merged into a single write.
+
+The writer uses QTableFile: dirty rows are written in place with the header
+last, and when the file has to grow it is written to a temp file and renamed.
+Both work on copies taken by save(), the writer never reads the live table.
+
+'''
+import threading
+import time
+
+import numpy as np
+
+import QTableFile
+
+
+class Checkpointer:
+    def __init__(self, table, path, verbose=True):
+        self.table = table
+        self.path = path
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = []
+        self.full = None
+        self.n_rows = 0
+
+        # Layout of the file (key width, actions, capacity), as it will be after the pending writes.
+        current = QTableFile.layout(path)
+        self.filelayout = None if current is None else (current[0], current[1], current[3])
+        self.requested = False
+        self.stopping = False
+
+        # Stats
+        self.requests = 0
+        self.writes = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        self.failures = 0
+
+        self.thread = threading.Thread(target=self._run, name='qtable-checkpointer', daemon=True)
+        self.thread.start()
+
+    def save(self):
+        # Snapshot taken in the caller thread: the dirty rows, or the whole table when the file has to grow.
+        table = self.table
+        n_rows = table.n_rows
+        key_width = QTableFile.table_key_width(table)
+        rows = table.take_dirty()
+
+        with self.lock:
+            filelayout = self.filelayout
+        if filelayout is None or filelayout[:2] != (key_width, table.n_actions) or filelayout[2] < n_rows:
+            capacity = n_rows + max(table.chunk, n_rows // 4)
+            full = (list(table.keys[:n_rows]), table.values[:n_rows].copy(), key_width, capacity)
+            with self.lock:
+                self.full = full
+                # Rows queued before are in the snapshot too.
+                self.pending = []
+                self.filelayout = (key_width, table.n_actions, capacity)
+                self.n_rows = n_rows
+                self.requests += 1
+                self.requested = True
+            self.wakeup.set()
+            return
+
+        keys = [table.keys[i] for i in rows]
+        values = table.values[rows]
+
+        with self.lock:
+            if len(rows):
+                self.pending.append((rows, keys, values))
+            self.n_rows = n_rows
+            self.requests += 1
+            self.requested = True
+        self.wakeup.set()
+
+    def close(self, timeout=None):
+        # Flushes what is pending and stops the writer.
+        with self.lock:
+            self.stopping = True
+        self.wakeup.set()
+        self.thread.join(timeout)
+
+    def _merge(self, pending):
+        # Keep only the newest copy of each row.
+        rows = np.concatenate([p[0] for p in pending])
+        keys = [k for p in pending for k in p[1]]
+        values = np.concatenate([p[2] for p in pending])
+
+        last = {}
+        for i, rowid in enumerate(rows.tolist()):
+            last[rowid] = i
+        order = sorted(last)
+        take = [last[r] for r in order]
+        return np.array(order, dtype=np.int64), [keys[i] for i in take], values[take]
+
+    def _write(self, full, pending, n_rows, filelayout):
+        key_width, n_actions, capacity = filelayout
+        written = 0
+        if full is not None:
+            keys, values, key_width, capacity = full
+            QTableFile.write_full(self.path, keys, values, key_width, capacity)
+            written = len(keys)
+            if not pending and n_rows == len(keys):
+                return written
+
+        if pending:
+            rows, keys, values = self._merge(pending)
+        else:
+            rows, keys, values = np.empty(0, dtype=np.int64), [], np.empty((0, n_actions), dtype=np.float32)
+        QTableFile.write_rows(self.path, rows, keys, values, key_width, n_rows, capacity)
+        return written + len(rows)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            with self.lock:
+                self.wakeup.clear()
+                pending, self.pending = self.pending, []
+                full, self.full = self.full, None
+                requested, self.requested = self.requested, False
+                n_rows = self.n_rows
+                filelayout = self.filelayout
+                stopping = self.stopping
+
+            if requested:
+                start = time.perf_counter()
+                try:
+                    rows = self._write(full, pending, n_rows, filelayout)
+                except Exception as e:
+                    # Keep the thread alive, the next save() rewrites the whole file.
+                    self.failures += 1
+                    print("Q-table checkpoint failed: %r" % e)
+                    with self.lock:
+                        self.filelayout = None
+                else:
+                    latency = time.perf_counter() - start
+
+                    self.writes += 1
+                    self.last_latency = latency
+                    self.max_latency = max(self.max_latency, latency)
+                    self.total_latency += latency
+                    if self.verbose:
+                        print("Q-table checkpoint: %d rows in %.1f ms (%d requests, %d writes)." % (
+                            rows, latency * 1000, self.requests, self.writes))
+
+            if stopping:
+                break
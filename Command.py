@@ -1,15 +1,61 @@
 import socket
-from struct import *
+import struct
 import datetime, time
+import atexit
+import json
 from TelemetryDictionary import telemetrydirs as td
+from Protocol import CommandOrder
 import sys
 
-import math
 import numpy as np
 
+class CommandEncoder:
+    '''
+    Keeps one CommandOrder in a reusable bytearray and sends it through a
+    connected UDP socket.
+
+    Only the head of the struct (controllingid ... command) changes from tick
+    to tick, so it is packed in place with one precompiled Struct.pack_into;
+    the tail (spawnid ... weapon) is packed once.  Packing the changed fields
+    one by one from Python is slower than this single call.
+    '''
+    # controllingid, thrust, steering, turretdeclination, yaw, turretbearing, bank, faction, timer, command
+    head = struct.Struct(CommandOrder.code[:CommandOrder.index['command'] + 1])
+
+    def __init__(self, ip='127.0.0.1', controlport=4501, faction=1):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((ip, controlport))
+
+        self.buffer = bytearray(CommandOrder.size)
+        CommandOrder.pack_into(self.buffer, 0, 0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, faction, 0, 0, 0, 0, 0.0, 0.0, 0.0, 0, False, 0)
+
+        self.yaw = 0.0
+        self.bank = 0.0
+        self.faction = faction
+
+    def set(self, name, value):
+        # For the fields that are not in the head (spawnid, x, y, z, target, bit, weapon).
+        CommandOrder.pack_field(self.buffer, name, value)
+
+    def encode(self, timer, controllingid, thrust, steering, turretdeclination, turretbearing, command=0):
+        self.head.pack_into(self.buffer, 0, controllingid, thrust, steering, turretdeclination,
+                            self.yaw, turretbearing, self.bank, self.faction, timer, command)
+        return self.buffer
+
+    def send(self, timer, controllingid, thrust, steering, turretdeclination, turretbearing, command=0):
+        self.head.pack_into(self.buffer, 0, controllingid, thrust, steering, turretdeclination,
+                            self.yaw, turretbearing, self.bank, self.faction, timer, command)
+        try:
+            return self.sock.send(self.buffer)
+        except ConnectionRefusedError:
+            # Nobody listening yet (ICMP port unreachable on a connected socket).
+            return 0
+
+
 class Command:
     def __init__(self, ip='127.0.0.1', controlport=4501):
-        self.ctrlsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.encoder = CommandEncoder(ip, controlport)
+        self.ctrlsock = self.encoder.sock
         self.ctrl_server_address = (ip, controlport)
 
         self.command = 0
@@ -26,48 +72,92 @@ class Command:
         self.command = 11
 
     def send_command(self,timer, controllingid, thrust, steering, turretdeclination, turretbearing):
-        spawnid=0
-        typeofisland=0
-        x=0.0
-        y=0.0
-        z=0.0
-        target=0
-        bit=0
-        weapon=0
-        yaw=0
-        bank=0
-        faction=1
-
         # Thrust is the speed of the tank. >0 is forward, <0 is backwards.
         # Steering controls the direction of the tank. >0 is right, <0 is left.
         # turretdeclination is the pitch movement, the control of the turret. >0 is up, <0 is down, 90 is straight up.
         # TurretBearing is the rotation of the turret. >0 is right, <0 is left.
 
-        # This is the structure fron CommandOrder
-        data=pack("iffffffiLiiifffi?i",
-            controllingid,
-            thrust,
-            steering,
-            turretdeclination,
-            yaw,
-            turretbearing,
-            bank,
-            faction,
-            timer,
-            self.command,    # 0 or 11
-            spawnid,
-            typeofisland,
-            x,y,z,
-            target,
-            bit,
-            weapon)
-
-        sent = self.ctrlsock.sendto(data, self.ctrl_server_address)
+        # The rest of the CommandOrder fields stay as the encoder initialized them.
+        self.encoder.send(timer, controllingid, thrust, steering, turretdeclination, turretbearing,
+                          self.command)    # 0 or 11
 
         if (self.heatup > 0):
             self.heatup -= 1
         self.command = 0
     
+class CommandChannel(Command):
+    '''
+    Drop-in replacement for Command that cuts the traffic to the simulator:
+
+    - A command equal to the last one sent is not sent again, except every
+      keepalive ticks (in case a datagram got lost).
+    - Changes are sent at most once every `every` simulator ticks, the last
+      values win.
+    - One-shot commands (fire=11, reset=13) are never skipped and are sent
+      exactly once for the tick they were asked for, even if send_command
+      is called more than once in that tick.
+
+    Ticks are the simulator timer, so the limit follows the simulation and
+    not the wall clock.
+    '''
+    ONESHOTS = (11, 13)
+
+    def __init__(self, ip='127.0.0.1', controlport=4501, every=1, keepalive=60):
+        super().__init__(ip, controlport)
+        self.every = every
+        self.keepalive = keepalive
+
+        self.last = None
+        self.lasttick = None
+        self.delivered = set()
+
+        # Stats
+        self.sent = 0
+        self.skipped = 0
+        self.oneshots = 0
+
+    def reset(self):
+        self.command = 13
+
+    def send_command(self, timer, controllingid, thrust, steering, turretdeclination, turretbearing):
+        values = (controllingid, thrust, steering, turretdeclination, turretbearing)
+        command = self.command
+        self.command = 0
+
+        if self.lasttick is not None and timer < self.lasttick:
+            # The simulation was reset, the timer starts again.
+            self.lasttick = None
+            self.delivered.clear()
+
+        if command in self.ONESHOTS:
+            if (command, timer) in self.delivered:
+                command = 0
+            else:
+                self.delivered.add((command, timer))
+                if len(self.delivered) > 64:
+                    self.delivered = {d for d in self.delivered if d[1] >= timer - 1}
+
+        if command == 0 and self.lasttick is not None:
+            elapsed = timer - self.lasttick
+            if values == self.last:
+                if elapsed < self.keepalive:
+                    self.skipped += 1
+                    return
+            elif elapsed < self.every:
+                self.skipped += 1
+                return
+
+        self.encoder.send(timer, controllingid, thrust, steering, turretdeclination, turretbearing, command)
+        self.last = values
+        self.lasttick = timer
+        self.sent += 1
+        if command:
+            self.oneshots += 1
+
+        if (self.heatup > 0):
+            self.heatup -= 1
+
+
 class Recorder:
     def __init__(self):
         ts = time.time()
@@ -111,3 +201,177 @@ class Recorder:
                     turretdecl,
                     turretbearing)
 
+
+# Layout of one recorded tick, same columns as the CSV from Recorder plus
+# action: id of the action of the shot fired on that tick, -1 when none.
+episodedtype = np.dtype([
+    ('timer', '<u8'),
+    ('x1', '<f4'), ('z1', '<f4'), ('b1', '<f4'), ('h1', '<f4'), ('p1', '<f4'),
+    ('x2', '<f4'), ('z2', '<f4'), ('b2', '<f4'), ('h2', '<f4'), ('p2', '<f4'),
+    ('st', '<f4'), ('th', '<f4'), ('turdecl', '<f4'), ('turbear', '<f4'),
+    ('action', '<i4')])
+
+EPISODE_MAGIC = b'EPIS'
+
+
+class BinaryRecorder:
+    '''
+    Same interface as Recorder, but the ticks are kept in a preallocated
+    numpy buffer and written in blocks, column by column.
+
+    File: magic, header length, json header (the dtype), and then blocks of
+    (number of rows, column 1, column 2, ...).
+
+    The buffer is written when it has blockrows rows or when flushinterval
+    seconds passed since the last write, and always on close() / exit.
+    '''
+    def __init__(self, filename=None, blockrows=1024, flushinterval=5.0, dtype=episodedtype, tank=None):
+        if filename is None:
+            ts = time.time()
+            st = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d-%H-%M-%S')
+            # With the tank number, the controllers of both tanks start in the same second.
+            if tank is not None:
+                st = 'tank%d.%s' % (tank, st)
+            filename = './data/episode.'+st+'.bin'
+        self.filename = filename
+        self.dtype = dtype
+        self.blockrows = blockrows
+        self.flushinterval = flushinterval
+
+        self.buffer = np.zeros(blockrows, dtype=dtype)
+        self.n = 0
+        self.lastflush = time.monotonic()
+
+        self.f = open(filename, 'wb')
+        header = json.dumps({'fields': [[name, dtype[name].str] for name in dtype.names]}).encode()
+        self.f.write(EPISODE_MAGIC + struct.pack('<I', len(header)) + header)
+        self.f.flush()
+
+        atexit.register(self.close)
+
+    def record(self, timer, x1,z1,b1,h1,p1,x2,z2,b2,h2,p2,st,th,turdecl,turbear,action=-1):
+        self.buffer[self.n] = (timer, x1,z1,b1,h1,p1,x2,z2,b2,h2,p2,st,th,turdecl,turbear,action)
+        self.n += 1
+        if self.n == self.blockrows or (time.monotonic() - self.lastflush) > self.flushinterval:
+            self.flush()
+
+    def recordvalues(self, tank1values, tank2values, steering, thrust, turretdecl, turretbearing, action=-1):
+        self.record(tank1values[td['timer']],
+                    tank1values[td['x']],
+                    tank1values[td['z']],
+                    tank1values[td['bearing']],
+                    tank1values[td['health']],
+                    tank1values[td['power']],
+                    tank2values[td['x']],
+                    tank2values[td['z']],
+                    tank2values[td['bearing']],
+                    tank2values[td['health']],
+                    tank2values[td['power']],
+                    steering,
+                    thrust,
+                    turretdecl,
+                    turretbearing,
+                    action)
+
+    def flush(self):
+        if self.f is None:
+            return
+        if self.n > 0:
+            block = self.buffer[:self.n]
+            self.f.write(struct.pack('<I', self.n))
+            for name in self.dtype.names:
+                self.f.write(block[name].tobytes())
+            self.n = 0
+        self.f.flush()
+        self.lastflush = time.monotonic()
+
+    def close(self):
+        if self.f is None:
+            return
+        self.flush()
+        self.f.close()
+        self.f = None
+        atexit.unregister(self.close)
+
+
+def load_episode(filename):
+    # Reads a BinaryRecorder file into a structured array.
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:4] != EPISODE_MAGIC:
+        raise ValueError('Not an episode file: ' + filename)
+    headerlength = struct.unpack('<I', data[4:8])[0]
+    header = json.loads(data[8:8+headerlength].decode())
+    dtype = np.dtype([(name, code) for name, code in header['fields']])
+
+    blocks = []
+    offset = 8 + headerlength
+    while offset + 4 <= len(data):
+        n = struct.unpack('<I', data[offset:offset+4])[0]
+        offset += 4
+        block = np.empty(n, dtype=dtype)
+        for name in dtype.names:
+            size = n * dtype[name].itemsize
+            if offset + size > len(data):
+                # Truncated block (the recorder was killed while writing).
+                return np.concatenate(blocks) if blocks else np.empty(0, dtype=dtype)
+            block[name] = np.frombuffer(data, dtype=dtype[name], count=n, offset=offset)
+            offset += size
+        blocks.append(block)
+
+    return np.concatenate(blocks) if blocks else np.empty(0, dtype=dtype)
+
+
+def export_csv(filename, csvfilename):
+    # Same format that Recorder writes.
+    episode = load_episode(filename)
+    with open(csvfilename, 'w') as f:
+        f.write(','.join(episode.dtype.names) + '\n')
+        for row in episode.tolist():
+            f.write(','.join(str(v) for v in row) + '\n')
+
+
+if __name__ == '__main__':
+    # Micro benchmark: pack + sendto per command vs. the preallocated encoder.
+    import timeit
+
+    n = 100000
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink.setblocking(False)
+    address = sink.getsockname()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    state = {'timer': 0}
+
+    def old():
+        state['timer'] += 1
+        data = struct.pack("iffffffiLiiifffi?i", 1, 10.0, 3.0, 0.0, 0, 45.0, 0, 1, state['timer'], 0, 0, 0, 0.0, 0.0, 0.0, 0, 0, 0)
+        sock.sendto(data, address)
+
+    encoder = CommandEncoder(address[0], address[1])
+
+    def new():
+        state['timer'] += 1
+        encoder.send(state['timer'], 1, 10.0, 3.0, 0.0, 45.0)
+
+    def drain():
+        try:
+            while True:
+                sink.recv(128)
+        except BlockingIOError:
+            pass
+
+    for name, f in (('pack+sendto', old), ('CommandEncoder', new)):
+        total = 0.0
+        for i in range(10):
+            total += timeit.timeit(f, number=n // 10)
+            drain()
+        print('%-16s %.2f us per command' % (name, total / n * 1e6))
+
+    # Only the encoding, no socket.
+    t = timeit.timeit(lambda: struct.pack("iffffffiLiiifffi?i", 1, 10.0, 3.0, 0.0, 0, 45.0, 0, 1, 7, 0, 0, 0, 0.0, 0.0, 0.0, 0, 0, 0), number=n)
+    print('%-16s %.3f us per command' % ('pack only', t / n * 1e6))
+    t = timeit.timeit(lambda: encoder.encode(7, 1, 10.0, 3.0, 0.0, 45.0), number=n)
+    print('%-16s %.3f us per command' % ('encode only', t / n * 1e6))
@@ -18,6 +18,8 @@ import sys, select
 
 import socket
 
+from Protocol import ModelRecord, CommandOrder
+
 from TelemetryDictionary import telemetrydirs as td
 
 import math
@@ -57,7 +59,7 @@ def send_command(timer, controllingid, thrust, roll, pitch, yaw, precesion, bank
     weapon=0
 
     # This is the structure fron CommandOrder
-    data=pack("iffffffiLiiifffi?i",
+    data=CommandOrder.pack(
         controllingid,
         thrust,     # Forward or backward
         roll,
@@ -87,8 +89,8 @@ min = -400
 max = 400
 
 # Telemetry length and package form.
-length = 84
-unpackcode = 'Liiiffffffffffffffff'
+length = ModelRecord.size
+unpackcode = ModelRecord.code
 
 if (len(sys.argv)>=2):
     print ("Reading which data to shown")
@@ -0,0 +1,199 @@
+'''
+Episode Store
+
+Keeps many recorded episodes in a columnar layout so they can be loaded
+for training or plotting without parsing CSVs:
+
+    ./data/store/manifest.csv               one line per episode
+    ./data/store/<episode>/<column>.npy     one file per column
+
+The manifest has the episode id, tank, number of ticks, final health of
+both tanks, damage totals and the reward of that damage, so queries only
+read the manifest and then memory map the columns of the episodes that
+were selected.
+
+A recording keeps going across the simulator resets, so a file is split
+where the timer starts again and every episode gets its own id
+(<file>.0, <file>.1, ... when there is more than one).
+
+Columns are the ones of Recorder / BinaryRecorder (x1.. is the controlled
+tank, x2.. is the enemy).
+
+'''
+import csv
+import os
+import sys
+
+import numpy as np
+
+from Command import load_episode, episodedtype
+
+manifestfields = ['episode', 'tank', 'ticks', 'start_timer', 'end_timer',
+                  'final_health', 'enemy_final_health', 'damage_dealt', 'damage_taken', 'hit_reward']
+
+# Same reward per point of damage that terminator.py gives to a hit.  The
+# misses (-50 each) are not known from the health alone, hit_reward is only
+# damage_dealt * HIT_REWARD.
+HIT_REWARD = 20
+
+
+def _damage(health):
+    # Sum of the health drops, health going up (a reset) does not count.
+    drops = -np.diff(np.asarray(health, dtype=np.float64))
+    return float(drops[drops > 0].sum())
+
+
+def split_episodes(episode):
+    # A recording can have several episodes, the timer starts again after a reset.
+    breaks = np.flatnonzero(np.diff(np.asarray(episode['timer']).astype(np.int64)) < 0) + 1
+    return np.split(np.arange(len(episode['timer'])), breaks)
+
+
+def load_csv_episode(filename):
+    # ./data/episode.*.dat files written by Recorder.
+    with open(filename) as f:
+        names = f.readline().strip().split(',')
+    values = np.loadtxt(filename, delimiter=',', skiprows=1, ndmin=2)
+    episode = np.zeros(len(values), dtype=episodedtype)
+    # Recorder does not write the action, no shot is known.
+    episode['action'] = -1
+    for i, name in enumerate(names):
+        if name in episodedtype.names:
+            episode[name] = values[:, i]
+    return episode
+
+
+class EpisodeStore:
+    def __init__(self, root='./data/store'):
+        self.root = root
+        self.manifestfile = os.path.join(root, 'manifest.csv')
+        os.makedirs(root, exist_ok=True)
+        self._manifest = None
+
+    def __len__(self):
+        return len(self.manifest)
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = []
+            if os.path.exists(self.manifestfile):
+                with open(self.manifestfile) as f:
+                    for row in csv.DictReader(f):
+                        if 'reward_total' in row:
+                            # Older manifests, the column had the same value.
+                            row['hit_reward'] = row.pop('reward_total')
+                        row['tank'] = int(row['tank'])
+                        for name in manifestfields[2:]:
+                            row[name] = float(row[name])
+                        self._manifest.append(row)
+        return self._manifest
+
+    def add(self, episode, episodeid, tank=1):
+        '''Stores a structured array (or dict of columns) as a new episode.'''
+        if episodeid in self.ids():
+            raise ValueError('Episode already in the store: ' + episodeid)
+        names = episode.dtype.names if hasattr(episode, 'dtype') else list(episode.keys())
+
+        folder = os.path.join(self.root, episodeid)
+        os.makedirs(folder, exist_ok=True)
+        for name in names:
+            np.save(os.path.join(folder, name + '.npy'), np.ascontiguousarray(episode[name]))
+
+        ticks = len(episode[names[0]])
+        damage_dealt = _damage(episode['h2']) if ticks else 0.0
+        row = {
+            'episode': episodeid,
+            'tank': int(tank),
+            'ticks': float(ticks),
+            'start_timer': float(episode['timer'][0]) if ticks else 0.0,
+            'end_timer': float(episode['timer'][-1]) if ticks else 0.0,
+            'final_health': float(episode['h1'][-1]) if ticks else 0.0,
+            'enemy_final_health': float(episode['h2'][-1]) if ticks else 0.0,
+            'damage_dealt': damage_dealt,
+            'damage_taken': _damage(episode['h1']) if ticks else 0.0,
+            'hit_reward': damage_dealt * HIT_REWARD}
+
+        newfile = not os.path.exists(self.manifestfile)
+        with open(self.manifestfile, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=manifestfields)
+            if newfile:
+                writer.writeheader()
+            writer.writerow(row)
+        self.manifest.append(row)
+        return episodeid
+
+    def import_file(self, filename, tank=1):
+        '''
+        Adds the episodes of an episode.*.bin (BinaryRecorder) or
+        episode.*.dat (Recorder) file, returns the ids added (the ones
+        already in the store are skipped).
+        '''
+        name = os.path.splitext(os.path.basename(filename))[0]
+        if filename.endswith('.bin'):
+            recording = load_episode(filename)
+        else:
+            recording = load_csv_episode(filename)
+
+        parts = [rows for rows in split_episodes(recording) if len(rows)]
+        known = set(self.ids())
+        added = []
+        for i, rows in enumerate(parts):
+            episodeid = name if len(parts) == 1 else '%s.%d' % (name, i)
+            if episodeid not in known:
+                added.append(self.add(recording[rows[0]:rows[-1] + 1], episodeid, tank=tank))
+        return added
+
+    def ids(self):
+        return [row['episode'] for row in self.manifest]
+
+    def select(self, tank=None, min_ticks=0, where=None):
+        '''Episode ids that match, only the manifest is read.'''
+        ids = []
+        for row in self.manifest:
+            if tank is not None and row['tank'] != tank:
+                continue
+            if row['ticks'] < min_ticks:
+                continue
+            if where is not None and not where(row):
+                continue
+            ids.append(row['episode'])
+        return ids
+
+    def load(self, episodeid, columns=None):
+        # Dict column -> memory mapped array.
+        folder = os.path.join(self.root, episodeid)
+        if columns is None:
+            columns = [name[:-4] for name in sorted(os.listdir(folder)) if name.endswith('.npy')]
+        return {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode='r') for name in columns}
+
+    def load_many(self, ids, columns):
+        '''
+        Concatenates the columns of many episodes.  Returns the dict of
+        columns and the offsets, episode i is rows offsets[i]:offsets[i+1].
+        '''
+        parts = {name: [] for name in columns}
+        offsets = [0]
+        for episodeid in ids:
+            episode = self.load(episodeid, columns)
+            for name in columns:
+                parts[name].append(episode[name])
+            offsets.append(offsets[-1] + len(episode[columns[0]]))
+        data = {}
+        for name in columns:
+            data[name] = np.concatenate(parts[name]) if parts[name] else np.empty(0)
+        return data, np.array(offsets, dtype=np.int64)
+
+
+if __name__ == '__main__':
+    # python EpisodeStore.py tank ./data/episode.*.bin
+    if len(sys.argv) < 3:
+        print('Usage: python EpisodeStore.py tank episodefiles...')
+        quit()
+
+    store = EpisodeStore()
+    for filename in sys.argv[2:]:
+        added = store.import_file(filename, tank=int(sys.argv[1]))
+        if added:
+            print('Imported %s: %d episodes' % (filename, len(added)))
+    print('Episodes in store: %d' % len(store))
@@ -0,0 +1,200 @@
+'''
+Fake Wakuseibokan
+
+Stand-in for the simulator to load test and train the controllers without
+the real game.  It speaks the same protocol:
+
+- Every tick sends one ModelRecord per tank to every telemetry port
+  (4601, 4602, ... one per tank, and optionally 4500).
+- Receives CommandOrders on 4501, 4502, ... (one port per tank).
+
+Tanks move on a plane with simple kinematics driven by thrust and steering.
+A fire command (11) shoots a projectile in the turret direction that takes
+health away from the tank it hits, and a reset command (13) starts a new
+episode.
+
+Bearings follow what the controllers expect: the enemy bearing is
+atan2(dz, dx) + 90 and a tank with bearing b moves towards b + 180, so
+steering = 0 means straight to the target and the turret bearing is
+relative to the hull (turretbearing = target - b + 180).
+
+    python FakeSimulator.py [tanks] [ticks per second, 0 is as fast as possible]
+
+'''
+import math
+import socket
+import sys
+import time
+
+import numpy as np
+
+from Protocol import ModelRecord, CommandOrder
+
+
+class FakeSimulator:
+    def __init__(self, tanks=2, rate=60, ip='127.0.0.1', telemetryports=None, commandports=None,
+                 arena=1500.0, seed=None):
+        self.n = tanks
+        self.rate = rate
+        self.ip = ip
+        self.arena = arena
+        self.random = np.random.RandomState(seed)
+
+        if telemetryports is None:
+            telemetryports = [4600 + i for i in range(1, tanks + 1)]
+        if commandports is None:
+            commandports = [4500 + i for i in range(1, tanks + 1)]
+        self.destinations = [(ip, port) for port in telemetryports]
+
+        self.out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.commandsocks = []
+        for port in commandports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('0.0.0.0', port))
+            sock.setblocking(False)
+            self.commandsocks.append(sock)
+
+        # Physics
+        self.maxspeed = 2.0          # units per tick at thrust 10
+        self.turnrate = 0.2          # degrees per tick per unit of steering
+        self.bulletspeed = 20.0      # units per tick
+        self.bulletlife = 100        # ticks
+        self.hitradius = 20.0
+        self.damage = 10.0
+
+        self.buffer = bytearray(ModelRecord.size * self.n)
+        self.reset()
+
+    def reset(self):
+        self.timer = 0
+        self.x = self.random.uniform(-self.arena, self.arena, self.n)
+        self.z = self.random.uniform(-self.arena, self.arena, self.n)
+        self.bearing = self.random.uniform(0, 360, self.n)
+        self.health = np.full(self.n, 100.0)
+        self.power = np.full(self.n, 1000, dtype=np.int64)
+
+        self.thrust = np.zeros(self.n)
+        self.steering = np.zeros(self.n)
+        self.turretdecl = np.zeros(self.n)
+        self.turretbearing = np.zeros(self.n)
+
+        # Projectiles: x, z, dx, dz, ticks left, owner
+        self.bullets = np.zeros((0, 6))
+
+        self.episodes = getattr(self, 'episodes', 0) + 1
+
+    def poll_commands(self):
+        fire = []
+        reset = False
+        for sock in self.commandsocks:
+            while True:
+                try:
+                    data = sock.recv(256)
+                except BlockingIOError:
+                    break
+                if len(data) != CommandOrder.size:
+                    continue
+                c = CommandOrder.todict(CommandOrder.unpack(data))
+                i = c['controllingid'] - 1
+                if not 0 <= i < self.n:
+                    continue
+                self.thrust[i] = c['thrust']
+                self.steering[i] = c['steering']
+                self.turretdecl[i] = c['turretdeclination']
+                self.turretbearing[i] = c['turretbearing']
+                if c['command'] == 11:
+                    fire.append(i)
+                elif c['command'] == 13:
+                    reset = True
+        return fire, reset
+
+    def shoot(self, i):
+        if self.power[i] <= 0:
+            return
+        self.power[i] -= 1
+        aim = math.radians(self.bearing[i] + self.turretbearing[i] - 180)
+        # More declination, longer flight.
+        life = self.bulletlife * (1 + self.turretdecl[i] / 10.0)
+        self.bullets = np.vstack([self.bullets, [self.x[i], self.z[i],
+                                                 self.bulletspeed * math.sin(aim), -self.bulletspeed * math.cos(aim),
+                                                 life, i]])
+
+    def step(self):
+        fire, reset = self.poll_commands()
+        if reset:
+            self.reset()
+            return
+        for i in fire:
+            self.shoot(i)
+
+        alive = self.health > 0
+        self.bearing = (self.bearing + np.where(alive, self.steering * self.turnrate, 0)) % 360
+        heading = np.radians(self.bearing + 180)
+        speed = np.where(alive, np.clip(self.thrust, -10, 10) / 10.0 * self.maxspeed, 0)
+        self.x += speed * np.sin(heading)
+        self.z += -speed * np.cos(heading)
+
+        if len(self.bullets):
+            b = self.bullets
+            b[:, 0] += b[:, 2]
+            b[:, 1] += b[:, 3]
+            b[:, 4] -= 1
+            # Distance of every bullet to every tank.
+            d = np.hypot(b[:, 0, None] - self.x[None, :], b[:, 1, None] - self.z[None, :])
+            d[np.arange(len(b)), b[:, 5].astype(int)] = np.inf   # can not hit yourself
+            hit = d < self.hitradius
+            for bullet, tank in zip(*np.nonzero(hit)):
+                if b[bullet, 4] > 0:
+                    self.health[tank] = max(0.0, self.health[tank] - self.damage)
+                    b[bullet, 4] = 0
+            self.bullets = b[b[:, 4] > 0]
+
+        self.timer += 1
+
+    def emit(self):
+        for i in range(self.n):
+            ModelRecord.pack_into(self.buffer, i * ModelRecord.size,
+                                  self.timer, i + 1, float(self.health[i]), int(self.power[i]),
+                                  float(self.bearing[i]), float(self.x[i]), 0.0, float(self.z[i]),
+                                  float(self.thrust[i]), float(self.steering[i]), float(self.turretdecl[i]), float(self.turretbearing[i]),
+                                  0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        view = memoryview(self.buffer)
+        for destination in self.destinations:
+            for i in range(self.n):
+                self.out.sendto(view[i * ModelRecord.size:(i + 1) * ModelRecord.size], destination)
+
+    def run(self, ticks=None):
+        period = 1.0 / self.rate if self.rate else 0.0
+        next_tick = time.perf_counter()
+        count = 0
+        while ticks is None or count < ticks:
+            self.step()
+            self.emit()
+            count += 1
+            if period:
+                next_tick += period
+                delay = next_tick - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_tick = time.perf_counter()
+
+    def close(self):
+        self.out.close()
+        for sock in self.commandsocks:
+            sock.close()
+
+
+if __name__ == '__main__':
+    tanks = int(sys.argv[1]) if len(sys.argv) >= 2 else 2
+    rate = float(sys.argv[2]) if len(sys.argv) >= 3 else 60
+
+    simulator = FakeSimulator(tanks, rate)
+    print('Fake simulator: %d tanks at %s ticks per second' % (tanks, rate or 'max'))
+    print('Telemetry to %s, commands on %s' % (simulator.destinations, [s.getsockname()[1] for s in simulator.commandsocks]))
+    try:
+        simulator.run()
+    except KeyboardInterrupt:
+        pass
+    simulator.close()
+    print('Everything successfully closed.')
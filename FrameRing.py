@@ -0,0 +1,116 @@
+'''
+Latest Frame Ring
+
+A receiver thread reads the telemetry (TelemetryIngest) and publishes every
+complete frame into a ring buffer, while the policy loop always takes the
+newest frame.  Slow work in the policy loop (Q updates, recording, prints)
+does not back up the socket anymore: frames the policy did not get to are
+skipped and counted as dropped.
+
+Only the receiver thread writes.  It fills the slot first and then moves the
+write counter, so the reader never sees a slot that is half written (like
+a seqlock, but with the GIL doing the atomic part).
+
+'''
+import socket
+import threading
+import time
+
+
+class LatestFrameRing:
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        # Number of frames published so far.
+        self.head = 0
+        self.ready = threading.Event()
+
+    def publish(self, frame):
+        # Producer only.
+        self.slots[self.head % self.capacity] = (time.perf_counter(), frame)
+        self.head += 1
+        self.ready.set()
+
+    def newest(self):
+        # (sequence number, receive time, frame) of the newest frame, or None.
+        head = self.head
+        if head == 0:
+            return None
+        received, frame = self.slots[(head - 1) % self.capacity]
+        return head - 1, received, frame
+
+
+class FrameReceiver:
+    def __init__(self, ingest, capacity=64, staleafter=0.05):
+        self.ingest = ingest
+        self.ring = LatestFrameRing(capacity)
+        self.staleafter = staleafter
+
+        self.lastseq = -1
+        self.timedout = False
+        self.running = True
+        self.stopped = False
+        self.error = None
+
+        # Stats
+        self.consumed = 0
+        self.dropped = 0
+        self.stale = 0
+
+        self.thread = threading.Thread(target=self._run, name='telemetry-receiver', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while self.running:
+                try:
+                    frames = self.ingest.poll()
+                except socket.timeout:
+                    self.timedout = True
+                    self.ring.ready.set()
+                    continue
+                except OSError as e:
+                    # Socket closed.
+                    if self.running:
+                        self.error = e
+                    break
+                self.timedout = False
+                for frame in frames:
+                    self.ring.publish(frame)
+        except Exception as e:
+            # e.g. select on a closed socket raises ValueError.
+            self.error = e
+        finally:
+            # Wake up latest() so it does not wait for frames that never come.
+            self.stopped = True
+            self.ring.ready.set()
+
+    def latest(self):
+        '''
+        Waits for a frame newer than the last one returned and returns the
+        newest.  Raises socket.timeout when the ingest stopped receiving and
+        RuntimeError when the receiver thread stopped.
+        '''
+        while True:
+            newest = self.ring.newest()
+            if newest is not None and newest[0] > self.lastseq:
+                break
+            if self.timedout:
+                raise socket.timeout('No telemetry received')
+            if self.stopped:
+                raise RuntimeError('Telemetry receiver stopped: %r' % self.error)
+            self.ring.ready.wait(self.ingest.timeout)
+            self.ring.ready.clear()
+
+        seq, received, frame = newest
+        if self.lastseq >= 0:
+            self.dropped += seq - self.lastseq - 1
+        self.lastseq = seq
+        self.consumed += 1
+        if time.perf_counter() - received > self.staleafter:
+            self.stale += 1
+        return frame
+
+    def close(self):
+        self.running = False
+        self.ingest.close()
@@ -0,0 +1,138 @@
+'''
+Tank geometry kernels.
+
+The bearing, distance, turret bearing and steering used by lock_enemigo,
+acercar_enemigo and circular_enemigo, written once with numpy for arrays
+(many tanks, many duels, or a whole recording: TankEnv and the offline
+code).  On one tank and one tick numpy costs more than the math, so the
+live controller uses the *_scalar versions, the same formulas with the
+math module.
+
+Conventions of the simulator: the bearing to the enemy is atan2(dz, dx)
+plus 90 degrees (0..360), and a tank with bearing b moves towards b + 180.
+
+'''
+import math
+import sys
+import time
+
+import numpy as np
+
+# Distances where the behaviours of terminator.py switch.
+APPROACH_DISTANCE = 300
+CIRCLE_DISTANCE = 100
+
+
+def bearing_to(x, z, enemy_x, enemy_z):
+    # Bearing from (x, z) to the enemy, 0..360
+    return (np.degrees(np.arctan2(np.subtract(enemy_z, z), np.subtract(enemy_x, x))) + 360 + 90) % 360
+
+
+def distance(x, z, enemy_x, enemy_z):
+    return np.hypot(np.subtract(enemy_x, x), np.subtract(enemy_z, z))
+
+
+def turret_bearing(bearing, mybearing):
+    # Turret bearing (relative to the hull) that points to bearing.
+    return bearing - np.asarray(mybearing) + 180
+
+
+def lock(x, z, mybearing, enemy_x, enemy_z):
+    '''Bearing, distance and turret bearing to the enemy, in one pass.'''
+    bearing = bearing_to(x, z, enemy_x, enemy_z)
+    return bearing, distance(x, z, enemy_x, enemy_z), turret_bearing(bearing, mybearing)
+
+
+def thrust_for(steering):
+    # Slow down on the sharp turns.
+    return np.where(np.abs(steering) >= 15, 3.0, 10.0)
+
+
+def approach(bearing, mybearing):
+    '''(thrust, steering) to go to the enemy (acercar_enemigo).'''
+    steering = np.where(bearing > 180, bearing - mybearing - 180, bearing - mybearing + 180)
+    steering = np.clip(steering, -15, 15)
+    return thrust_for(steering), steering
+
+
+def circle(bearing, mybearing):
+    '''(thrust, steering) to go around the enemy (circular_enemigo).'''
+    steering = ((bearing + 90) % 360 - mybearing) % 360
+    # Normalize steering to be within -180 to 180 degrees
+    steering = np.where(steering > 180, steering - 360, steering)
+    return thrust_for(steering), steering
+
+
+def steer(bearing, distance, mybearing, thrust, steering, lastbearing,
+          approachdistance=APPROACH_DISTANCE, circledistance=CIRCLE_DISTANCE):
+    '''
+    Both behaviours on arrays: approach when farther than approachdistance,
+    circle when closer than circledistance, in between keep the last thrust,
+    steering and bearing.  Returns (thrust, steering, bearing).
+    '''
+    far = distance > approachdistance
+    near = distance < circledistance
+    athrust, asteering = approach(bearing, mybearing)
+    cthrust, csteering = circle(bearing, mybearing)
+    thrust = np.where(far, athrust, np.where(near, cthrust, thrust))
+    steering = np.where(far, asteering, np.where(near, csteering, steering))
+    bearing = np.where(far | near, bearing, lastbearing)
+    return thrust, steering, bearing
+
+
+def bearing_to_scalar(x, z, enemy_x, enemy_z):
+    return (math.degrees(math.atan2(enemy_z - z, enemy_x - x)) + 360 + 90) % 360
+
+
+def distance_scalar(x, z, enemy_x, enemy_z):
+    return math.hypot(enemy_x - x, enemy_z - z)
+
+
+def turret_bearing_scalar(bearing, mybearing):
+    return bearing - mybearing + 180
+
+
+def thrust_for_scalar(steering):
+    return 3.0 if abs(steering) >= 15 else 10.0
+
+
+def approach_scalar(bearing, mybearing):
+    steering = bearing - mybearing - 180 if bearing > 180 else bearing - mybearing + 180
+    steering = min(max(steering, -15), 15)
+    return thrust_for_scalar(steering), steering
+
+
+def circle_scalar(bearing, mybearing):
+    steering = ((bearing + 90) % 360 - mybearing) % 360
+    if steering > 180:
+        steering -= 360
+    return thrust_for_scalar(steering), steering
+
+
+def lock_records(myrecords, otherrecords):
+    # lock() on structured arrays of ModelRecords (telemetry dumps, EpisodeStore columns).
+    return lock(myrecords['x'], myrecords['z'], myrecords['bearing'], otherrecords['x'], otherrecords['z'])
+
+
+if __name__ == '__main__':
+    # Scalar math loop (like the controllers) against one numpy pass.
+    n = int(sys.argv[1]) if len(sys.argv) >= 2 else 100000
+    r = np.random.RandomState(0)
+    x, z, ex, ez = r.uniform(-1500, 1500, (4, n))
+    b = r.uniform(0, 360, n)
+
+    x, z, ex, ez, b = x.tolist(), z.tolist(), ex.tolist(), ez.tolist(), b.tolist()
+    start = time.perf_counter()
+    for i in range(n):
+        bearing = bearing_to_scalar(x[i], z[i], ex[i], ez[i])
+        d = distance_scalar(x[i], z[i], ex[i], ez[i])
+        turretbearing = turret_bearing_scalar(bearing, b[i])
+        thrust, steering = approach_scalar(bearing, b[i])
+    scalar = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bearing, d, turretbearing = lock(x, z, b, ex, ez)
+    thrust, steering = approach(bearing, b)
+    batch = time.perf_counter() - start
+
+    print('%d pairs: scalar %.1f ms, numpy %.1f ms (%.0fx)' % (n, scalar * 1000, batch * 1000, scalar / batch))
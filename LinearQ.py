@@ -0,0 +1,220 @@
+'''
+Linear Q-function with tile coding
+
+The tabular state packs 14 discretized dimensions (absolute x/z cells
+included) into one key, so almost every state is new, the table is very
+sparse and a shot learned in one cell says nothing about the next one.
+
+Here Q(s, a) = sum of the weights of the tiles active in s, one weight
+row per tile and one column per action.  The inputs are the same as the
+table (bearing, distance, turret bearing, positions, enemy velocity) and
+they are tiled in small groups (bearing with turret bearing, distance
+with turret bearing, enemy velocity with turret bearing, ...), each group
+with several tilings offset by a fraction of a tile.  Nearby states share
+most of their tiles, so they generalize, and the weight matrix has a
+fixed size given by the spec (constant memory, it does not grow with the
+states seen).
+
+To keep the int64 state keys that Trainer, RewardScheduler and
+ReplayBuffer pass around, the state is still a StateDiscretizer key, but on
+a grid tilings times finer than the tiles: the tile of every tiling is
+(fine bin + tiling) // tilings, exactly the tile of the offset tiling.
+
+LinearQ has the methods of QTable that the agents use (argmax,
+argmax_many, max, update, update_many), LinearQAgent is TableAgent on top
+of it, so it works with TankEnv.Trainer and ReplayBuffer.replay as is.
+
+    python LinearQ.py [duels] [ticks] [weights.npz]
+
+'''
+import os
+import sys
+import time
+
+import numpy as np
+
+from StateDiscretizer import StateDiscretizer
+from TankEnv import TankEnv, TableAgent, train
+
+# (field, source, tile width, (lo, hi) clip range of the tile)
+linear_spec = [
+    ('bearing',        'bearing',        45,  (0, 7)),
+    ('distance',       'distance',       100, (0, 63)),
+    ('turretbearing',  'turretbearing',  45,  (-7, 12)),
+    ('x',              'x',              400, (-8, 7)),
+    ('z',              'z',              400, (-8, 7)),
+    ('my_bearing',     'my_bearing',     45,  (0, 7)),
+    ('enemy_x',        'enemy_x',        400, (-8, 7)),
+    ('enemy_z',        'enemy_z',        400, (-8, 7)),
+    ('enemy_dx',       'enemy_dx',       2,   (-4, 3)),
+    ('enemy_dz',       'enemy_dz',       2,   (-4, 3)),
+]
+
+# Fields tiled together, every group is a set of tilings.
+linear_groups = [
+    ('turretbearing',),
+    ('distance',),
+    ('bearing', 'turretbearing'),
+    ('distance', 'turretbearing'),
+    ('turretbearing', 'enemy_dx', 'enemy_dz'),
+    ('my_bearing', 'enemy_dx', 'enemy_dz'),
+    ('x', 'z'),
+    ('enemy_x', 'enemy_z'),
+]
+
+
+class TileCoder:
+    def __init__(self, spec=linear_spec, groups=linear_groups, tilings=4):
+        self.tilings = tilings
+        # Fine grid: tilings bins per tile, the last tile also gets its tilings - 1 offset bins.
+        self.discretizer = StateDiscretizer([(field, source, width / float(tilings), (lo * tilings, hi * tilings + tilings - 1))
+                                             for field, source, width, (lo, hi) in spec])
+        fields = [s[0] for s in spec]
+
+        # Tile numbers of a field go from lo // tilings to (hi + tilings - 1) // tilings over the fine bins.
+        d = self.discretizer
+        self.tilelo = d.lo // tilings
+        tileradix = (d.hi + tilings - 1) // tilings - self.tilelo + 1
+
+        # Every (group, tiling) is a dense block of tiles, base is where it starts.
+        self.groups = []
+        size = 1  # Tile 0 is the bias, active in every state.
+        for group in groups:
+            dims = np.array([fields.index(f) for f in group], dtype=np.intp)
+            radix = tileradix[dims]
+            strides = np.ones(len(dims), dtype=np.int64)
+            for i in range(len(dims) - 2, -1, -1):
+                strides[i] = strides[i + 1] * radix[i + 1]
+            block = int(strides[0] * radix[0])
+            self.groups.append((dims, strides, size + block * np.arange(tilings, dtype=np.int64)))
+            size += block * tilings
+        self.size = size
+        self.n_active = 1 + len(self.groups) * tilings
+
+    def bins(self, states):
+        # Fine bins of every key, [states, fields].
+        d = self.discretizer
+        keys = np.asarray(states, dtype=np.int64).reshape(-1, 1)
+        return keys // d.strides % d.radix + d.lo
+
+    def active(self, states):
+        '''Ids of the active tiles, [states, n_active].'''
+        bins = self.bins(states)
+        offsets = np.arange(self.tilings, dtype=np.int64).reshape(-1, 1, 1)
+        tiles = (bins[None, :, :] + offsets) // self.tilings - self.tilelo
+        out = np.empty((len(bins), self.n_active), dtype=np.int64)
+        out[:, 0] = 0
+        column = 1
+        for dims, strides, base in self.groups:
+            out[:, column:column + self.tilings] = (tiles[:, :, dims] @ strides + base[:, None]).T
+            column += self.tilings
+        return out
+
+
+class LinearQ:
+    def __init__(self, n_actions, coder=None, dtype=np.float32):
+        self.n_actions = int(n_actions)
+        self.coder = TileCoder() if coder is None else coder
+        self.weights = np.zeros((self.coder.size, self.n_actions), dtype=dtype)
+
+        # Stats
+        self.updates = 0
+
+    def __len__(self):
+        # Tiles with some weight, the memory itself is fixed.
+        return int(np.count_nonzero(self.weights.any(axis=1)))
+
+    def values(self, states):
+        # Q values of every state, [states, actions].
+        return self.weights[self.coder.active(states)].sum(axis=1, dtype=np.float64)
+
+    def row(self, state):
+        # A copy, the values are not stored per state.
+        return self.values([state])[0]
+
+    def argmax(self, state):
+        return int(np.argmax(self.values([state])[0]))
+
+    def argmax_many(self, states):
+        return np.argmax(self.values(states), axis=1)
+
+    def max(self, state):
+        return float(self.values([state])[0].max())
+
+    def update(self, state, action, reward, next_state, learning_rate, discount_factor):
+        # Gradient step of one step Q-learning, learning_rate is shared by the active tiles.
+        active = self.coder.active([state, next_state])
+        q = self.weights[active].sum(axis=1, dtype=np.float64)
+        td_error = reward + discount_factor * q[1].max() - q[0, action]
+        self.weights[active[0], action] += learning_rate * td_error / self.coder.n_active
+        self.updates += 1
+        return td_error
+
+    def update_many(self, states, actions, rewards, next_states, learning_rate, discount_factor, weights=None):
+        '''
+        Batch version of update, like QTable.update_many: the TD errors are
+        computed with the weights as they were and every (tile, action)
+        moves by the mean of its samples.  Returns the TD errors.
+        '''
+        actions = np.asarray(actions, dtype=np.int64)
+        n = len(actions)
+        active = self.coder.active(np.concatenate([np.asarray(states, dtype=np.int64), np.asarray(next_states, dtype=np.int64)]))
+        q = self.weights[active].sum(axis=1, dtype=np.float64)
+        td_error = np.asarray(rewards, dtype=np.float64) + discount_factor * q[n:].max(axis=1) - q[np.arange(n), actions]
+
+        weighted = td_error if weights is None else td_error * weights
+        cells, inverse, counts = np.unique((active[:n] * self.n_actions + actions[:, None]).ravel(),
+                                           return_inverse=True, return_counts=True)
+        change = learning_rate / self.coder.n_active * np.bincount(inverse, weights=np.repeat(weighted, self.coder.n_active)) / counts
+        self.weights.reshape(-1)[cells] += change.astype(self.weights.dtype)
+        self.updates += n
+        return td_error
+
+    def save(self, path):
+        np.savez(path, weights=self.weights, tilings=self.coder.tilings)
+
+    @classmethod
+    def load(cls, path, coder=None):
+        data = np.load(path)
+        coder = TileCoder(tilings=int(data['tilings'])) if coder is None else coder
+        q = cls(data['weights'].shape[1], coder, data['weights'].dtype)
+        if q.weights.shape != data['weights'].shape:
+            raise ValueError('Weights of %s do not match the tile coder.' % path)
+        q.weights[:] = data['weights']
+        return q
+
+
+class LinearQAgent(TableAgent):
+    '''
+    TableAgent with a LinearQ instead of the table: choose_action,
+    choose_actions and update_q_table are the same, the state keys come
+    from the fine grid of the tile coder.
+    '''
+    def __init__(self, linear=None, actions=None, coder=None):
+        TableAgent.__init__(self, actions=actions)
+        if linear is None:
+            linear = LinearQ(len(self.acciones), coder)
+        self.q_table = linear
+        self.discretizer = linear.coder.discretizer
+
+
+if __name__ == '__main__':
+    duels = int(sys.argv[1]) if len(sys.argv) >= 2 else 256
+    ticks = int(sys.argv[2]) if len(sys.argv) >= 3 else 5000
+    path = sys.argv[3] if len(sys.argv) >= 4 else None
+
+    env = TankEnv(duels, seed=0)
+    agent = LinearQAgent(LinearQ.load(path) if path and os.path.exists(path) else None)
+    print('%d tiles x %d actions (%.1f MB), %d active per state' % (
+        agent.q_table.coder.size, agent.q_table.n_actions, agent.q_table.weights.nbytes / 1e6, agent.q_table.coder.n_active))
+
+    start = time.perf_counter()
+    total = train(env, agent, ticks)
+    elapsed = time.perf_counter() - start
+
+    print('%d duels x %d ticks in %.1f s: %.0f duel ticks per second' % (duels, ticks, elapsed, duels * ticks / elapsed))
+    print('Episodes: %d, shots: %d, hits: %d, kills: %d, total reward: %.0f, tiles used: %d' % (
+        env.episodes, env.shots, env.hits, env.kills, total, len(agent.q_table)))
+    if path:
+        agent.q_table.save(path)
+        print('Weights saved to %s' % path)
@@ -0,0 +1,210 @@
+'''
+Offline Q-learning from recorded episodes
+
+Rebuilds the (state, action, reward, next state) of every shot from the
+episodes that terminator.py recorded (BinaryRecorder .bin files or an
+EpisodeStore) and fits the Q-table with batch updates over the whole
+dataset, instead of replaying the simulation.
+
+What terminator.py records per tick is the position, bearing, health and
+power of both tanks, st = turret declination, th = bearing correction,
+the turret bearing and the action id of the shot fired on that tick (-1
+when none).  From that:
+
+- The state is computed again like on the live tick (Geometry for the
+  bearing, distance, turret bearing and behaviours, StateDiscretizer).
+- A shot is a tick with an action, that is the action learned.
+  Recordings without the action column (older files, Recorder CSVs) have
+  no known shots and are left out.
+- The reward is the same delayed rule, with the same RewardScheduler:
+  delay simulator ticks later, the health drops credited to the shot
+  (only inside the flight window of its distance at firing) times 20, or -50 when it missed, and 5000 for the last shot when the
+  enemy goes below 50.
+
+    python OfflineTrainer.py epochs q_table.qtab episodes.bin... | ./data/store
+
+'''
+import os
+import sys
+import time
+
+import numpy as np
+
+from Command import load_episode
+from EpisodeStore import EpisodeStore, load_csv_episode, split_episodes
+from QTable import QTable
+from RewardScheduler import RewardScheduler, flight_window
+from StateDiscretizer import StateDiscretizer, terminator_spec
+from TankEnv import terminator_actions
+import Geometry
+import QTableFile
+
+DELAY = 150
+HIT_REWARD = 20
+MISS_REWARD = -50
+DESTROY_REWARD = 5000
+
+
+def states(episode, discretizer, circledistance=Geometry.CIRCLE_DISTANCE):
+    '''State key of every tick, computed the way terminator.py does on the live tick.'''
+    x, z, mybearing = [np.asarray(episode[c], dtype=np.float64) for c in ('x1', 'z1', 'b1')]
+    enemy_x, enemy_z = [np.asarray(episode[c], dtype=np.float64) for c in ('x2', 'z2')]
+    n = len(x)
+
+    bearing, distance, turretbearing = Geometry.lock(x, z, mybearing, enemy_x, enemy_z)
+
+    # In between the two distances the last behaviour goes on: take the values of the last tick that had one.
+    active = (distance > Geometry.APPROACH_DISTANCE) | (distance < circledistance)
+    last = np.maximum.accumulate(np.where(active, np.arange(n), -1))
+    last = np.where(last < 0, np.arange(n), last)
+    athrust, asteering = Geometry.approach(bearing, mybearing)
+    cthrust, csteering = Geometry.circle(bearing, mybearing)
+    near = distance < circledistance
+    thrust = np.where(near[last], cthrust[last], athrust[last])
+    steering = np.where(near[last], csteering[last], asteering[last])
+
+    prev_x = np.concatenate([enemy_x[:1], enemy_x[:-1]])
+    prev_z = np.concatenate([enemy_z[:1], enemy_z[:-1]])
+
+    return discretizer.keys({
+        'bearing': bearing[last],
+        'distance': distance,
+        'turretbearing': turretbearing,
+        'turretdecl': np.zeros(n),
+        'thrust': thrust,
+        'steering': steering,
+        'x': x,
+        'z': z,
+        'my_bearing': mybearing,
+        'enemy_x': enemy_x,
+        'enemy_z': enemy_z,
+        'enemy_dx': prev_x - enemy_x,
+        'enemy_dz': prev_z - enemy_z,
+        'enemy_bearing': np.asarray(episode['b2'], dtype=np.float64)})
+
+
+def transitions(episode, discretizer, delay=DELAY):
+    '''(states, actions, rewards, next states) of the shots of one episode.'''
+    keys = states(episode, discretizer)
+    n = len(keys)
+    timer = np.asarray(episode['timer'], dtype=np.int64)
+    health = np.asarray(episode['h2'], dtype=np.float64)
+    distance = Geometry.distance(*[np.asarray(episode[c], dtype=np.float64) for c in ('x1', 'z1', 'x2', 'z2')])
+    turretdecl = np.asarray(episode['st'], dtype=np.float64)
+
+    end = n
+    destroyed = np.flatnonzero(health < 50)
+    if len(destroyed):
+        # terminator resets the episode there.
+        end = int(destroyed[0]) + 1
+
+    recorded = np.asarray(episode['action'], dtype=np.int64)[:end]
+    shots = np.flatnonzero(recorded >= 0)
+    shotactions = dict(zip(shots.tolist(), recorded[shots].tolist()))
+
+    # Replay the ticks through the scheduler, like the live loop.
+    scheduler = RewardScheduler(delay, HIT_REWARD, MISS_REWARD)
+    s, a, r, s2 = [], [], [], []
+    for i in range(end):
+        t = int(timer[i])
+        if i in shotactions:
+            scheduler.schedule(t, int(keys[i]), shotactions[i], health[i],
+                               window=flight_window(float(distance[i]), float(turretdecl[i])))
+        scheduler.observe(t, health[i])
+        for shot, reward in scheduler.resolve(t):
+            s.append(shot.state)
+            a.append(shot.action)
+            r.append(reward)
+            s2.append(keys[i])
+
+    if len(destroyed) and scheduler.last is not None:
+        s.append(scheduler.last.state)
+        a.append(scheduler.last.action)
+        r.append(DESTROY_REWARD)
+        s2.append(keys[end - 1])
+
+    # End of the episode, the shots in flight get what they did.
+    for shot, reward in scheduler.clear():
+        s.append(shot.state)
+        a.append(shot.action)
+        r.append(reward)
+        s2.append(keys[end - 1])
+
+    return (np.array(s, dtype=np.int64), np.array(a, dtype=np.int64),
+            np.array(r, dtype=np.float64), np.array(s2, dtype=np.int64))
+
+
+def load_sources(sources):
+    '''Episodes (structured arrays or dicts of columns) of .bin/.dat files and EpisodeStore folders.'''
+    episodes = []
+    for source in sources:
+        if os.path.isdir(source):
+            store = EpisodeStore(source)
+            for episodeid in store.ids():
+                episodes.append(store.load(episodeid))
+        elif source.endswith('.bin'):
+            episodes.append(load_episode(source))
+        else:
+            episodes.append(load_csv_episode(source))
+    return episodes
+
+
+def has_actions(episode):
+    names = episode.dtype.names if hasattr(episode, 'dtype') else episode.keys()
+    return 'action' in names and bool((np.asarray(episode['action']) >= 0).any())
+
+
+def dataset(episodes, discretizer, delay=DELAY):
+    parts = []
+    for episode in episodes:
+        if not has_actions(episode):
+            continue
+        for rows in split_episodes(episode):
+            if len(rows) > 1:
+                parts.append(transitions({c: np.asarray(episode[c])[rows] for c in ('timer', 'x1', 'z1', 'b1', 'x2', 'z2', 'b2', 'h2', 'st', 'action')},
+                                         discretizer, delay))
+    if not parts:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0), np.empty(0, np.int64)
+    return tuple(np.concatenate([p[i] for p in parts]) for i in range(4))
+
+
+def fit(table, data, epochs=10, learning_rate=0.1, discount_factor=0.2, batchsize=None, seed=None):
+    '''Batch Q updates over the whole dataset, returns the mean |TD error| of every epoch.'''
+    s, a, r, s2 = data
+    random = np.random.RandomState(seed)
+    history = []
+    for _ in range(epochs):
+        order = random.permutation(len(s))
+        size = batchsize or len(s)
+        errors = []
+        for start in range(0, len(s), size):
+            batch = order[start:start + size]
+            errors.append(table.update_many(s[batch], a[batch], r[batch], s2[batch], learning_rate, discount_factor))
+        history.append(float(np.abs(np.concatenate(errors)).mean()) if errors else 0.0)
+    return history
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('Usage: python OfflineTrainer.py epochs q_table.qtab episodes.bin... | ./data/store')
+        quit()
+
+    epochs = int(sys.argv[1])
+    path = sys.argv[2]
+    actions = terminator_actions()
+    discretizer = StateDiscretizer(terminator_spec)
+
+    start = time.perf_counter()
+    episodes = load_sources(sys.argv[3:])
+    data = dataset(episodes, discretizer)
+    loaded = time.perf_counter() - start
+    print('%d recordings (%d without recorded shots), %d shots (%d hits) in %.2f s' % (
+        len(episodes), sum(1 for e in episodes if not has_actions(e)), len(data[0]), int(np.count_nonzero(data[2] > 0)), loaded))
+
+    table = QTableFile.load(path) if os.path.exists(path) else QTable(len(actions))
+    start = time.perf_counter()
+    history = fit(table, data, epochs)
+    print('%d epochs in %.2f s, mean |TD error| %s' % (epochs, time.perf_counter() - start, ' '.join('%.1f' % e for e in history)))
+
+    QTableFile.save(table, path)
+    print('Q-table saved to %s: %d states' % (path, len(table)))
@@ -15,6 +15,8 @@ import sys, select
 
 import socket
 
+from Protocol import ModelRecord
+
 from TelemetryDictionary import telemetrydirs as td
 
 
@@ -26,8 +28,8 @@ min = -400
 max = 400
 
 # Telemetry length and package form.
-length = 84
-unpackcode = 'Liiiffffffffffffffff'
+length = ModelRecord.size
+unpackcode = ModelRecord.code
 
 if (len(sys.argv)>=2):
     print ("Reading which data to shown")
@@ -0,0 +1,192 @@
+'''
+Parallel Q-learning Trainer
+
+K worker processes train at the same time, each one with its own TankEnv
+and its own copy of the Q-table.  The training goes in rounds:
+
+1. Every worker gets the master rows that changed in the last round and
+   copies them into its table.
+2. Every worker trains ticks steps and sends back, for every state it
+   updated, the change of its Q values (delta) and how many updates every
+   action got (visits).
+3. The master merges them: each Q value moves by the average of the
+   worker deltas weighted by their visits, so a worker that saw a state
+   once does not cancel one that learned it a hundred times.
+
+Only the master writes the table file (in the background, Checkpointer), so
+workers never overwrite each other.
+
+    python ParallelTrainer.py [workers] [rounds] [ticks per round] [duels per worker] [q_table.qtab]
+
+'''
+import multiprocessing
+import os
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from QTable import QTable
+from TankEnv import TankEnv, TableAgent, Trainer
+from Checkpointer import Checkpointer
+import QTableFile
+
+
+class CountingAgent(TableAgent):
+    # TableAgent that counts the updates of every (state, action).
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.visits = defaultdict(lambda: np.zeros(len(self.acciones), dtype=np.int64))
+
+    def update_q_table(self, state, action, reward, next_state):
+        self.visits[state][action] += 1
+        return super().update_q_table(state, action, reward, next_state)
+
+
+def _worker(conn, n_actions, duels, seed):
+    np.random.seed(seed)
+    agent = CountingAgent(QTable(n_actions))
+    trainer = Trainer(TankEnv(duels, seed=seed), agent)
+    table = agent.q_table
+    previous = (0, 0, 0, 0)
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        ticks, keys, values = message
+
+        # Master rows first.
+        for key, row in zip(keys, values):
+            table.row(key)[:] = row
+        base = table.values[:table.n_rows].copy()
+
+        agent.visits.clear()
+        start = time.perf_counter()
+        total = trainer.run(ticks)
+        elapsed = time.perf_counter() - start
+
+        states = list(agent.visits)
+        rows = table.row_ids(states)
+        deltas = table.values[rows].copy()
+        old = rows < len(base)
+        deltas[old] -= base[rows[old]]
+        visits = np.array([agent.visits[s] for s in states], dtype=np.int64).reshape(len(states), n_actions)
+
+        env = trainer.env
+        # The env counters are cumulative, the stats are for this round only.
+        counters = (env.episodes, env.shots, env.hits, env.kills)
+        stats = (total, elapsed) + tuple(c - p for c, p in zip(counters, previous))
+        previous = counters
+        conn.send((states, deltas, visits, stats))
+    conn.close()
+
+
+class ParallelTrainer:
+    def __init__(self, table, workers=None, duels=256, path=None):
+        self.table = table
+        self.n_workers = workers or os.cpu_count() or 1
+        self.checkpointer = Checkpointer(table, path) if path else None
+
+        # Rows of the master changed by the last merge, sent to the workers in the next round.
+        self.changed = list(table.keys)
+
+        self.conns = []
+        self.processes = []
+        for i in range(self.n_workers):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker, args=(child, table.n_actions, duels, 1000 + i),
+                                              name='trainer-%d' % i, daemon=True)
+            process.start()
+            child.close()
+            self.conns.append(parent)
+            self.processes.append(process)
+
+        # Stats
+        self.rounds = 0
+        self.merged = 0
+        self.stats = []
+
+    def merge(self, results):
+        '''Adds the visit weighted average of the worker deltas to the master table.'''
+        keys = [k for states, deltas, visits in results for k in states]
+        if not keys:
+            return []
+        deltas = np.concatenate([d for states, d, visits in results])
+        visits = np.concatenate([v for states, deltas, v in results]).astype(np.float64)
+
+        unique = list(dict.fromkeys(keys))
+        slot = {k: i for i, k in enumerate(unique)}
+        where = np.fromiter((slot[k] for k in keys), dtype=np.int64, count=len(keys))
+
+        weighted = np.zeros((len(unique), deltas.shape[1]))
+        total = np.zeros((len(unique), deltas.shape[1]))
+        np.add.at(weighted, where, deltas * visits)
+        np.add.at(total, where, visits)
+        change = np.divide(weighted, total, out=np.zeros_like(weighted), where=total > 0)
+
+        # add() marks the row dirty for the checkpointer and, on a SharedQTable, holds the row lock.
+        change = change.astype(self.table.values.dtype)
+        for k, c in zip(unique, change):
+            self.table.add(k, c)
+        self.merged += len(unique)
+        return unique
+
+    def round(self, ticks):
+        rows = self.table.row_ids(self.changed)
+        message = (ticks, self.changed, self.table.values[rows])
+        for conn in self.conns:
+            conn.send(message)
+
+        results = []
+        stats = []
+        for conn in self.conns:
+            states, deltas, visits, workerstats = conn.recv()
+            results.append((states, deltas, visits))
+            stats.append(workerstats)
+
+        self.changed = self.merge(results)
+        self.rounds += 1
+        self.stats = stats
+        if self.checkpointer is not None:
+            self.checkpointer.save()
+        return stats
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+            conn.close()
+        for process in self.processes:
+            process.join()
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+
+
+if __name__ == '__main__':
+    workers = int(sys.argv[1]) if len(sys.argv) >= 2 else os.cpu_count()
+    rounds = int(sys.argv[2]) if len(sys.argv) >= 3 else 10
+    ticks = int(sys.argv[3]) if len(sys.argv) >= 4 else 1000
+    duels = int(sys.argv[4]) if len(sys.argv) >= 5 else 256
+    path = sys.argv[5] if len(sys.argv) >= 6 else 'q_table.qtab'
+
+    if os.path.exists(path):
+        table = QTableFile.load(path)
+    else:
+        table = QTable(len(TableAgent().acciones))
+    trainer = ParallelTrainer(table, workers, duels, path)
+    print('Training with %d workers, %d duels each' % (trainer.n_workers, duels))
+
+    start = time.perf_counter()
+    for r in range(rounds):
+        stats = trainer.round(ticks)
+        reward = sum(s[0] for s in stats)
+        shots = sum(s[3] for s in stats)
+        hits = sum(s[4] for s in stats)
+        kills = sum(s[5] for s in stats)
+        print('Round %d: reward %.0f, shots %d, hits %d, kills %d, states %d' % (r + 1, reward, shots, hits, kills, len(table)))
+    elapsed = time.perf_counter() - start
+    trainer.close()
+
+    print('%d duel ticks in %.1f s: %.0f per second' % (trainer.n_workers * duels * ticks * rounds, elapsed,
+                                                        trainer.n_workers * duels * ticks * rounds / elapsed))
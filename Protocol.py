@@ -0,0 +1,121 @@
+'''
+Wakuseibokan wire formats.
+
+ModelRecord (networking/telemetry.cpp) is what the simulator sends, one per
+tank per tick.  CommandOrder (commandorder.h) is what it expects to control
+a tank.  Both are defined here only once; the struct format, the sizes, the
+offsets and the numpy dtype are generated from the field lists.
+
+Formats use native alignment, like the C structs ('L' is 8 bytes on 64 bit
+Linux and macOS), so ModelRecord is 84 bytes and CommandOrder 76.
+
+'''
+import struct
+
+import numpy as np
+
+
+class WireFormat:
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = list(fields)
+        self.names = [f[0] for f in self.fields]
+        self.code = ''.join(f[1] for f in self.fields)
+
+        # Precompiled, no format parsing when packing/unpacking.
+        self.struct = struct.Struct(self.code)
+        self.size = self.struct.size
+
+        # Field name -> position in the unpacked tuple / byte offset.
+        self.index = {n: i for i, n in enumerate(self.names)}
+        self.offsets = {}
+        for i, (fieldname, code) in enumerate(self.fields):
+            self.offsets[fieldname] = struct.calcsize(self.code[:i + 1]) - struct.calcsize(code)
+
+        # One Struct per field, to pack_into a single field.
+        self.fieldstructs = {fieldname: struct.Struct(code) for fieldname, code in self.fields}
+
+        self.dtype = np.dtype({
+            'names': self.names,
+            'formats': [np.dtype(f[1]) for f in self.fields],
+            'offsets': [self.offsets[n] for n in self.names],
+            'itemsize': self.size})
+
+    def __repr__(self):
+        return '%s(%s, %d bytes)' % (self.name, self.code, self.size)
+
+    def validate(self, data):
+        if len(data) != self.size:
+            raise ValueError('%s must be %d bytes, got %d.' % (self.name, self.size, len(data)))
+
+    def pack(self, *values):
+        return self.struct.pack(*values)
+
+    def pack_into(self, buffer, offset, *values):
+        self.struct.pack_into(buffer, offset, *values)
+
+    def pack_field(self, buffer, fieldname, value, offset=0):
+        self.fieldstructs[fieldname].pack_into(buffer, offset + self.offsets[fieldname], value)
+
+    def unpack(self, data):
+        self.validate(data)
+        return self.struct.unpack(data)
+
+    def iter_unpack(self, buffer):
+        if len(buffer) % self.size:
+            raise ValueError('%s buffer length %d is not a multiple of %d.' % (self.name, len(buffer), self.size))
+        return self.struct.iter_unpack(buffer)
+
+    def decode(self, buffer):
+        # Zero copy structured array view of many records.
+        if len(buffer) % self.size:
+            raise ValueError('%s buffer length %d is not a multiple of %d.' % (self.name, len(buffer), self.size))
+        return np.frombuffer(buffer, dtype=self.dtype)
+
+    def todict(self, values):
+        return dict(zip(self.names, values))
+
+
+ModelRecord = WireFormat('ModelRecord', [
+    ('timer', 'L'),
+    ('number', 'i'),
+    ('health', 'f'),
+    ('power', 'i'),
+    ('bearing', 'f'),
+    ('x', 'f'),
+    ('y', 'f'),
+    ('z', 'f'),
+    ('R1', 'f'),
+    ('R2', 'f'),
+    ('R3', 'f'),
+    ('R4', 'f'),
+    ('R5', 'f'),
+    ('R6', 'f'),
+    ('R7', 'f'),
+    ('R8', 'f'),
+    ('R9', 'f'),
+    ('R10', 'f'),
+    ('R11', 'f'),
+    ('R12', 'f')])
+
+# Names in commandorder.h are roll, pitch, precesion for steering,
+# turretdeclination and turretbearing.
+CommandOrder = WireFormat('CommandOrder', [
+    ('controllingid', 'i'),
+    ('thrust', 'f'),
+    ('steering', 'f'),
+    ('turretdeclination', 'f'),
+    ('yaw', 'f'),
+    ('turretbearing', 'f'),
+    ('bank', 'f'),
+    ('faction', 'i'),
+    ('timer', 'L'),
+    ('command', 'i'),       # 0, 11 fire, 13 reset
+    ('spawnid', 'i'),
+    ('typeofisland', 'i'),
+    ('x', 'f'),
+    ('y', 'f'),
+    ('z', 'f'),
+    ('target', 'i'),
+    ('bit', '?'),
+    ('weapon', 'i')])
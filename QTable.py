@@ -0,0 +1,202 @@
+'''
+Array backed Q-table.
+
+Instead of a defaultdict with one small numpy array per state, every state
+(any hashable, normally the tuple or key returned by get_state) is interned
+into a dense row index and all the Q values live in one 2-D float32 matrix.
+The matrix grows by chunks, so adding a new state is usually just a dict
+insert.
+
+'''
+import pickle
+
+import numpy as np
+
+
+class QTable:
+    def __init__(self, n_actions, chunk=4096, dtype=np.float32):
+        self.n_actions = int(n_actions)
+        self.chunk = int(chunk)
+
+        # state -> row
+        self.index = {}
+        # row -> state
+        self.keys = []
+
+        self.values = np.zeros((self.chunk, self.n_actions), dtype=dtype)
+        self.n_rows = 0
+
+        # Rows changed since the last save.
+        self.dirty = set()
+
+    def __len__(self):
+        return self.n_rows
+
+    def __contains__(self, state):
+        return state in self.index
+
+    def __getitem__(self, state):
+        # Keeps the old q_table[state][action] access working.
+        return self.row(state)
+
+    def _grow(self):
+        capacity = self.values.shape[0] + self.chunk
+        values = np.zeros((capacity, self.n_actions), dtype=self.values.dtype)
+        values[:self.n_rows] = self.values[:self.n_rows]
+        self.values = values
+
+    def row_id(self, state):
+        rowid = self.index.get(state)
+        if rowid is None:
+            if self.n_rows == self.values.shape[0]:
+                self._grow()
+            rowid = self.n_rows
+            self.index[state] = rowid
+            self.keys.append(state)
+            self.n_rows += 1
+        return rowid
+
+    def row(self, state):
+        # This is a view, writing on it updates the table.
+        rowid = self.row_id(state)
+        self.dirty.add(rowid)
+        return self.values[rowid]
+
+    def argmax(self, state):
+        rowid = self.index.get(state)
+        if rowid is None:
+            # Unseen states are all zeros, do not allocate a row just for looking.
+            return 0
+        return int(np.argmax(self.values[rowid]))
+
+    def row_ids(self, states):
+        # Batch lookup, -1 for the states that are not in the table.
+        return np.fromiter((self.index.get(s, -1) for s in states), dtype=np.int64, count=len(states))
+
+    def argmax_many(self, states):
+        # Batch argmax, unseen states get action 0 like argmax.
+        rows = self.row_ids(states)
+        actions = np.zeros(len(rows), dtype=np.int64)
+        seen = rows >= 0
+        if seen.any():
+            actions[seen] = np.argmax(self.values[rows[seen]], axis=1)
+        return actions
+
+    def max(self, state):
+        rowid = self.index.get(state)
+        if rowid is None:
+            return 0.0
+        return float(self.values[rowid].max())
+
+    def update(self, state, action, reward, next_state, learning_rate, discount_factor):
+        # One step Q-learning, action is the column index.
+        td_target = reward + discount_factor * self.max(next_state)
+        q = self.row(state)
+        td_error = td_target - q[action]
+        q[action] += learning_rate * td_error
+        return td_error
+
+    def add(self, state, delta):
+        # Adds delta to every action of the state (ParallelTrainer merge).
+        rowid = self.row_id(state)
+        self.values[rowid] += delta
+        self.dirty.add(rowid)
+
+    def update_many(self, states, actions, rewards, next_states, learning_rate, discount_factor, weights=None):
+        '''
+        Batch one step Q-learning.  All the targets are computed with the
+        table as it was, then every (state, action) moves by the mean TD
+        error of its samples (times weights, the importance weights of a
+        prioritized replay).  Returns the TD errors.
+        '''
+        states = np.asarray(states).tolist()
+        next_states = np.asarray(next_states).tolist()
+        actions = np.asarray(actions, dtype=np.int64)
+
+        nextrows = self.row_ids(next_states)
+        next_values = np.zeros(len(nextrows))
+        seen = nextrows >= 0
+        if seen.any():
+            next_values[seen] = self.values[nextrows[seen]].max(axis=1)
+        td_target = np.asarray(rewards, dtype=np.float64) + discount_factor * next_values
+
+        rows = np.fromiter((self.row_id(s) for s in states), dtype=np.int64, count=len(states))
+        td_error = td_target - self.values[rows, actions]
+
+        cells, inverse, counts = np.unique(rows * self.n_actions + actions, return_inverse=True, return_counts=True)
+        weighted = td_error if weights is None else td_error * weights
+        change = learning_rate * np.bincount(inverse, weights=weighted) / counts
+        values = self.values.reshape(-1)
+        values[cells] += change.astype(values.dtype)
+        self.dirty.update(np.unique(rows).tolist())
+        return td_error
+
+    def items(self):
+        for state, rowid in self.index.items():
+            yield state, self.values[rowid]
+
+    def take_dirty(self):
+        # Sorted ids of the rows changed since the last call.
+        rows = np.fromiter(self.dirty, dtype=np.int64, count=len(self.dirty))
+        rows.sort()
+        self.dirty = set()
+        return rows
+
+    @classmethod
+    def from_arrays(cls, keys, values, n_rows, chunk=4096):
+        # values can be a np.memmap, it is only copied when the table grows.
+        qtable = cls(values.shape[1], chunk=chunk, dtype=values.dtype)
+        qtable.keys = list(keys[:n_rows])
+        qtable.index = {k: i for i, k in enumerate(qtable.keys)}
+        qtable.values = values
+        qtable.n_rows = n_rows
+        return qtable
+
+    @classmethod
+    def from_dict(cls, table, n_actions=None):
+        # Build from the old defaultdict(state -> np.array) q_table.
+        if n_actions is None:
+            n_actions = len(next(iter(table.values()))) if table else 0
+        qtable = cls(n_actions, chunk=max(len(table), 1))
+        for state, values in table.items():
+            qtable.row(state)[:] = values
+        return qtable
+
+
+def _default_q_value():
+    return None
+
+
+class _Unpickler(pickle.Unpickler):
+    # Old tables were pickled defaultdicts whose factory lived in the
+    # __main__ of the controller script that saved them.
+    def find_class(self, module, name):
+        if name == 'default_q_value':
+            return _default_q_value
+        return super().find_class(module, name)
+
+
+def load_pickle(path, discretizer=None):
+    '''
+    Loads an old pickled q_table.  With a discretizer only the int states
+    (packed keys like get_state makes now) are kept.  The old tuple states
+    can not be packed: their enemy velocity fields were really positions
+    (prev - x // 100) and the new clip ranges would merge different states,
+    so they are left out and counted.
+    '''
+    with open(path, 'rb') as f:
+        table = _Unpickler(f).load()
+    if not isinstance(table, QTable):
+        table = QTable.from_dict(table)
+    if discretizer is not None:
+        packed = QTable(table.n_actions, chunk=max(len(table), 1), dtype=table.values.dtype)
+        skipped = 0
+        for state, values in table.items():
+            if not isinstance(state, (int, np.integer)):
+                skipped += 1
+                continue
+            packed.row(int(state))[:] = values
+        if skipped:
+            print('%s: %d old tuple states left out, they do not match the packed state.' % (path, skipped))
+        table = packed
+    return table
@@ -0,0 +1,178 @@
+'''
+Binary Q-table file.
+
+Layout (little endian):
+
+    header   64 bytes: magic, version, key width, number of actions,
+             number of rows, capacity (rows reserved in the file)
+    keys     int64 [capacity, key width]
+    values   float32 [capacity, number of actions]
+
+The values are a contiguous matrix, so load() just memory maps it.  save()
+only writes the dirty rows when the file already has room for them; when it
+has to grow (or does not exist) the whole file is written to a temp file and
+renamed over the old one.
+
+Keys are ints (packed states) or tuples of ints (old style states).
+
+'''
+import os
+import struct
+import sys
+
+import numpy as np
+
+from QTable import QTable, load_pickle
+
+MAGIC = b'QTAB'
+VERSION = 1
+
+header = struct.Struct('<4sIIIQQ')
+HEADER_SIZE = 64
+
+
+def table_key_width(table):
+    if not len(table.keys):
+        return 1
+    key = table.keys[0]
+    return len(key) if isinstance(key, tuple) else 1
+
+
+def read_header(f):
+    f.seek(0)
+    magic, version, key_width, n_actions, n_rows, capacity = header.unpack(f.read(header.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a Q-table file (or unsupported version).')
+    return key_width, n_actions, n_rows, capacity
+
+
+def _write_header(f, key_width, n_actions, n_rows, capacity):
+    f.seek(0)
+    f.write(header.pack(MAGIC, VERSION, key_width, n_actions, n_rows, capacity).ljust(HEADER_SIZE, b'\0'))
+
+
+def _offsets(key_width, n_actions, capacity):
+    keysoffset = HEADER_SIZE
+    valuesoffset = keysoffset + capacity * key_width * 8
+    return keysoffset, valuesoffset
+
+
+def _key_array(keys, key_width):
+    return np.asarray(keys, dtype='<i8').reshape(-1, key_width)
+
+
+def layout(path):
+    # (key width, actions, rows, capacity) of an existing file, or None.
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        try:
+            return read_header(f)
+        except (ValueError, struct.error):
+            return None
+
+
+def save(table, path, capacity=None):
+    '''Write the table, only the dirty rows if the file layout allows it.'''
+    key_width = table_key_width(table)
+    rows = table.take_dirty()
+
+    current = layout(path)
+    if current is not None:
+        fkey_width, fn_actions, fn_rows, fcapacity = current
+        if fcapacity >= table.n_rows and (fkey_width, fn_actions) == (key_width, table.n_actions):
+            keys = [table.keys[i] for i in rows]
+            write_rows(path, rows, keys, table.values[rows], key_width, table.n_rows, fcapacity)
+            return len(rows)
+
+    # New file or not enough room: full rewrite.
+    if capacity is None:
+        capacity = table.n_rows + max(table.chunk, table.n_rows // 4)
+    n = table.n_rows
+    write_full(path, table.keys[:n], table.values[:n], key_width, capacity)
+    return n
+
+
+def write_rows(path, rows, keys, values, key_width, n_rows, capacity):
+    # rows must be sorted, keys and values are the ones of those rows.
+    n_actions = values.shape[1]
+    keysoffset, valuesoffset = _offsets(key_width, n_actions, capacity)
+    keybytes = key_width * 8
+    rowbytes = n_actions * 4
+    keys = _key_array(keys, key_width)
+    values = np.ascontiguousarray(values, dtype='<f4')
+
+    with open(path, 'r+b') as f:
+        if len(rows):
+            # Write consecutive row ids in one go.
+            breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+            start = 0
+            for run in np.split(rows, breaks):
+                end = start + len(run)
+                f.seek(keysoffset + int(run[0]) * keybytes)
+                f.write(keys[start:end].tobytes())
+                f.seek(valuesoffset + int(run[0]) * rowbytes)
+                f.write(values[start:end].tobytes())
+                start = end
+            f.flush()
+
+        # The header goes last, a crash before this keeps the old row count.
+        _write_header(f, key_width, n_actions, n_rows, capacity)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_full(path, keys, values, key_width, capacity):
+    n_actions = values.shape[1]
+    keysoffset, valuesoffset = _offsets(key_width, n_actions, capacity)
+    n = len(keys)
+
+    tmppath = path + '.tmp'
+    with open(tmppath, 'wb') as f:
+        _write_header(f, key_width, n_actions, n, capacity)
+        f.seek(keysoffset)
+        f.write(_key_array(keys, key_width).tobytes())
+        f.seek(valuesoffset)
+        f.write(np.ascontiguousarray(values[:n], dtype='<f4').tobytes())
+        # Reserve the rest of the file.
+        f.truncate(valuesoffset + capacity * n_actions * 4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+
+
+def load(path, mmap=True, chunk=4096):
+    with open(path, 'rb') as f:
+        key_width, n_actions, n_rows, capacity = read_header(f)
+    keysoffset, valuesoffset = _offsets(key_width, n_actions, capacity)
+
+    keys = np.fromfile(path, dtype='<i8', count=n_rows * key_width, offset=keysoffset)
+    if key_width == 1:
+        keys = keys.tolist()
+    else:
+        keys = [tuple(k) for k in keys.reshape(-1, key_width).tolist()]
+
+    if mmap:
+        # Copy on write, updates stay in memory until the next save.
+        values = np.memmap(path, dtype='<f4', mode='c', offset=valuesoffset, shape=(capacity, n_actions))
+    else:
+        values = np.fromfile(path, dtype='<f4', count=capacity * n_actions, offset=valuesoffset).reshape(capacity, n_actions)
+
+    return QTable.from_arrays(keys, values, n_rows, chunk=chunk)
+
+
+def import_pickle(pklpath, path):
+    # Converts the old q_table.pkl into the binary format.
+    table = load_pickle(pklpath)
+    if os.path.exists(path):
+        os.remove(path)
+    save(table, path)
+    return table
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: python QTableFile.py q_table.pkl q_table.qtab')
+        quit()
+    table = import_pickle(sys.argv[1], sys.argv[2])
+    print('Imported %d states with %d actions.' % (len(table), table.n_actions))
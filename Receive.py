@@ -24,6 +24,8 @@ import sys, select
 
 import socket
 
+from Protocol import ModelRecord
+
 
 ip = '0.0.0.0'
 port = 4500
@@ -41,8 +43,8 @@ sock.bind(server_address)
 
 # This is the length and format of the struct ModelRecord that is sent by the server.
 # Check https://docs.python.org/3/library/struct.html
-length = 84
-unpackcode = 'Liiiffffffffffffffff'
+length = ModelRecord.size
+unpackcode = ModelRecord.code
 
 address = ''
 while True:
@@ -52,7 +54,7 @@ while True:
 
     print (f'Data Received:{data}')
 
-    new_values = unpack(unpackcode,data)
+    new_values = ModelRecord.unpack(data)
 
     print(new_values[5])
 
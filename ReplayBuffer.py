@@ -0,0 +1,180 @@
+'''
+Prioritized Replay Buffer
+
+Keeps the resolved shots (state, action, reward, next state) so they are
+learned from many times instead of once.  Storage is a fixed capacity
+circular buffer of numpy arrays (the oldest shot is overwritten), and
+sampling is proportional to priority = (|TD error| + eps) ** alpha with a
+sum-tree, so the rare hits and the surprising misses come back more often.
+
+Everything works on whole batches: adding, sampling (one descent of the
+tree for all the samples at once) and updating the priorities.
+
+replay() learns ratio samples per shot added since the last call (the
+replay ratio), so a few shots are not replayed thousands of times, and
+stops earlier when its time budget is spent.
+
+    buffer.add(state, action, reward, next_state, td_error)
+    idx, (s, a, r, s2), weights = buffer.sample(32)
+    td = q_table.update_many(s, a, r, s2, lr, gamma, weights)
+    buffer.update_priorities(idx, td)
+
+'''
+import sys
+import time
+
+import numpy as np
+
+
+class SumTree:
+    def __init__(self, capacity):
+        # Leaves are tree[size:2 * size], node i has the sum of 2i and 2i + 1, the root is 1.
+        self.size = 1 << max(0, int(capacity - 1).bit_length())
+        self.depth = self.size.bit_length() - 1
+        self.tree = np.zeros(2 * self.size)
+
+    def total(self):
+        return self.tree[1]
+
+    def set(self, idx, priorities):
+        nodes = np.asarray(idx, dtype=np.int64) + self.size
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes >> 1)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def get(self, idx):
+        return self.tree[np.asarray(idx, dtype=np.int64) + self.size]
+
+    def find(self, values):
+        # Leaf of every value, cumulative sum of the leaves before it <= value.
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            right = values >= self.tree[left]
+            values -= np.where(right, self.tree[left], 0.0)
+            nodes = left + right
+        return nodes - self.size
+
+
+class ReplayBuffer:
+    def __init__(self, capacity=1 << 14, alpha=0.6, beta=0.4, eps=1.0, seed=None):
+        self.capacity = capacity
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.random = np.random.RandomState(seed)
+
+        self.states = np.zeros(capacity, dtype=np.int64)
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float64)
+        self.next_states = np.zeros(capacity, dtype=np.int64)
+
+        self.tree = SumTree(capacity)
+        self.maxpriority = 1.0
+
+        # Next slot to write and number of valid slots.
+        self.position = 0
+        self.size = 0
+
+        # Shots added since the last replay().
+        self.fresh = 0
+
+        # Stats
+        self.added = 0
+        self.sampled = 0
+
+    def __len__(self):
+        return self.size
+
+    def _priority(self, td_error):
+        return (np.abs(td_error) + self.eps) ** self.alpha
+
+    def add(self, state, action, reward, next_state, td_error=None):
+        '''Adds one shot, or many when the arguments are arrays.  New shots without td_error get the top priority.'''
+        states = np.atleast_1d(state)
+        n = len(states)
+        idx = (self.position + np.arange(n)) % self.capacity
+        self.states[idx] = states
+        self.actions[idx] = action
+        self.rewards[idx] = reward
+        self.next_states[idx] = next_state
+
+        if td_error is None:
+            priorities = np.full(n, self.maxpriority)
+        else:
+            priorities = np.broadcast_to(self._priority(np.asarray(td_error, dtype=np.float64)), (n,))
+            self.maxpriority = max(self.maxpriority, float(priorities.max()))
+        self.tree.set(idx, priorities)
+
+        self.position = int((self.position + n) % self.capacity)
+        self.size = min(self.capacity, self.size + n)
+        self.fresh += n
+        self.added += n
+        return idx
+
+    def sample(self, batchsize):
+        '''
+        Stratified sample by priority.  Returns the slots, the
+        (states, actions, rewards, next states) and the importance weights
+        (normalized to a max of 1).
+        '''
+        total = self.tree.total()
+        segment = total / batchsize
+        values = (np.arange(batchsize) + self.random.rand(batchsize)) * segment
+        idx = np.minimum(self.tree.find(np.minimum(values, total * (1 - 1e-12))), self.size - 1)
+
+        probabilities = self.tree.get(idx) / total
+        weights = (self.size * np.maximum(probabilities, 1e-12)) ** -self.beta
+        weights /= weights.max()
+
+        self.sampled += batchsize
+        return idx, (self.states[idx], self.actions[idx], self.rewards[idx], self.next_states[idx]), weights
+
+    def update_priorities(self, idx, td_error):
+        priorities = self._priority(np.asarray(td_error, dtype=np.float64))
+        self.maxpriority = max(self.maxpriority, float(priorities.max()))
+        self.tree.set(idx, priorities)
+
+    def replay(self, table, batchsize, learning_rate, discount_factor, budget, ratio=32):
+        '''
+        Learns ratio samples per shot added since the last call, in
+        minibatches (rounded up), to run between ticks.  budget (seconds)
+        is an upper bound, it stops after the batch that goes over it.
+        Returns the number of batches.
+        '''
+        if self.size < batchsize or not self.fresh:
+            return 0
+        todo = -(-self.fresh * ratio // batchsize)
+        # What the budget does not allow is not carried over to the next ticks.
+        self.fresh = 0
+        deadline = time.perf_counter() + budget
+        batches = 0
+        while batches < todo:
+            idx, (s, a, r, s2), weights = self.sample(batchsize)
+            td_error = table.update_many(s, a, r, s2, learning_rate, discount_factor, weights)
+            self.update_priorities(idx, td_error)
+            batches += 1
+            if time.perf_counter() >= deadline:
+                break
+        return batches
+
+
+if __name__ == '__main__':
+    # Sampling frequency follows the priority, and the cost of a batch.
+    n = int(sys.argv[1]) if len(sys.argv) >= 2 else 10000
+    buffer = ReplayBuffer(n, alpha=1.0, eps=0.0, seed=0)
+    td = np.arange(1, n + 1, dtype=np.float64)
+    buffer.add(np.arange(n), np.zeros(n), np.zeros(n), np.arange(n), td)
+
+    counts = np.zeros(n)
+    start = time.perf_counter()
+    rounds = 2000
+    for _ in range(rounds):
+        idx, _, _ = buffer.sample(32)
+        counts[idx] += 1
+    elapsed = time.perf_counter() - start
+    top, bottom = counts[n // 2:].sum(), counts[:n // 2].sum()
+    print('Top half sampled %.2f times the bottom half (expected %.2f)' % (top / bottom, td[n // 2:].sum() / td[:n // 2].sum()))
+    print('sample(32): %.1f us' % (elapsed / rounds * 1e6))
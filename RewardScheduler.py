@@ -0,0 +1,158 @@
+'''
+Delayed Reward Scheduler
+
+The reward of a shot is only known some ticks after firing.  Instead of one
+pending shot at a time (waiting_for_result) and a list scanned on every
+tick, shots go into a min-heap keyed by the simulator timer when they are
+due, and every tick only pops the ones that are due now (O(log n) each).
+Many shots can be in flight at the same time.
+
+Attribution: every shot has a window of ticks where its bullet can land
+(flight_window: the distance at firing over the bullet speed, give or
+take slack ticks for the enemy moving, and never after the bullet life).
+A drop of the enemy health is credited to the oldest shot without a hit
+whose window has the tick, shots whose window is over no longer take
+credit.  Without a window a shot can land any tick until it is due.
+When a shot is due its reward is the damage credited to it times
+hitreward, or missreward when it has none.
+
+    window = flight_window(distance, turretdecl)
+    scheduler.schedule(timer, state, action, enemyhealth, window=window)   # when firing
+    scheduler.observe(timer, enemyhealth)                   # every tick
+    for shot, reward in scheduler.resolve(timer):           # every tick
+        ...
+    for shot, reward in scheduler.clear():                  # end of the episode
+        ...
+
+At the end of the episode the shots still in flight are resolved with what
+they have (their damage, or a miss) before they are forgotten.  When
+observe() sees the timer go back without a clear(), they come out of the
+next resolve().
+
+'''
+import heapq
+import math
+from collections import deque
+
+# Bullets of the simulator (FakeSimulator and TankEnv do the same).
+BULLET_SPEED = 20.0     # units per tick
+BULLET_LIFE = 100       # ticks, times 1 + turretdecl / 10
+
+
+def flight_window(distance, turretdecl=0.0, slack=10, speed=BULLET_SPEED, life=BULLET_LIFE):
+    '''(first, last) ticks after firing where the bullet can hit, last < first when it cannot reach.'''
+    arrival = distance / speed
+    first = max(1, int(arrival) - slack)
+    last = min(int(math.ceil(arrival)) + slack, int(math.ceil(life * (1 + turretdecl / 10.0))))
+    return first, last
+
+
+class Shot:
+    __slots__ = ('fired', 'due', 'state', 'action', 'health', 'first', 'last', 'damage', 'resolved')
+
+    def __init__(self, fired, due, state, action, health, first=None, last=None):
+        self.fired = fired
+        self.due = due
+        self.state = state
+        self.action = action
+        # Enemy health when it was fired.
+        self.health = health
+        # Ticks where it can land.
+        self.first = fired + 1 if first is None else first
+        self.last = due if last is None else min(last, due)
+        self.damage = 0.0
+        self.resolved = False
+
+    def __repr__(self):
+        return 'Shot(fired=%d, due=%d, action=%d, damage=%.1f)' % (self.fired, self.due, self.action, self.damage)
+
+
+class RewardScheduler:
+    def __init__(self, delay=150, hitreward=20, missreward=-50, maxinflight=None):
+        self.delay = delay
+        self.hitreward = hitreward
+        self.missreward = missreward
+        self.maxinflight = maxinflight
+
+        self.heap = []
+        # Shots without a hit yet, in firing order.
+        self.unhit = deque()
+        self.seq = 0
+        self.lasthealth = None
+        self.lasttimer = -1
+        # Last shot fired, the one that gets the reward for destroying the enemy.
+        self.last = None
+        # Shots resolved by a clear() that observe() did.
+        self.flushed = []
+
+        # Stats
+        self.fired = 0
+        self.hits = 0
+        self.misses = 0
+        self.unattributed = 0.0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def can_fire(self):
+        return self.maxinflight is None or len(self.heap) < self.maxinflight
+
+    def schedule(self, timer, state, action, health, delay=None, window=None):
+        # window is (first, last) ticks after timer, see flight_window.
+        due = timer + (self.delay if delay is None else delay)
+        if window is None:
+            shot = Shot(timer, due, state, action, health)
+        else:
+            shot = Shot(timer, due, state, action, health, timer + window[0], timer + window[1])
+        heapq.heappush(self.heap, (due, self.seq, shot))
+        self.unhit.append(shot)
+        self.seq += 1
+        self.fired += 1
+        self.last = shot
+        return shot
+
+    def observe(self, timer, health):
+        '''Gives the health drop since the last tick to the shot that caused it.'''
+        if timer < self.lasttimer:
+            # The simulator started a new episode.
+            self.flushed.extend(self.clear())
+        self.lasttimer = timer
+
+        if self.lasthealth is not None and health < self.lasthealth:
+            drop = self.lasthealth - health
+            # Shots that can no longer land leave the queue.
+            while self.unhit and (self.unhit[0].resolved or self.unhit[0].last < timer):
+                self.unhit.popleft()
+            for shot in self.unhit:
+                if not shot.resolved and shot.first <= timer <= shot.last:
+                    shot.damage += drop
+                    self.unhit.remove(shot)
+                    break
+            else:
+                self.unattributed += drop
+        self.lasthealth = health
+
+    def resolve(self, timer):
+        '''(shot, reward) of every shot due at timer (or before).'''
+        done, self.flushed = self.flushed, []
+        while self.heap and self.heap[0][0] <= timer:
+            done.append(self._reward(heapq.heappop(self.heap)[2]))
+        return done
+
+    def _reward(self, shot):
+        shot.resolved = True
+        if shot.damage > 0:
+            self.hits += 1
+            return shot, shot.damage * self.hitreward
+        self.misses += 1
+        return shot, self.missreward
+
+    def clear(self):
+        '''End of the episode: (shot, reward) of the shots in flight, in firing order, and forgets them.'''
+        done = [self._reward(shot) for due, seq, shot in sorted(self.heap, key=lambda e: e[2].fired)]
+        self.heap = []
+        self.unhit.clear()
+        self.lasthealth = None
+        self.lasttimer = -1
+        self.last = None
+        return done
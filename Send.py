@@ -17,6 +17,8 @@ import sys, select
 
 import socket
 
+from Protocol import CommandOrder
+
 #from TelemetryDictionary import telemetrydirs
 
 # This is the port where the simulator is waiting for commands.
@@ -53,7 +55,7 @@ def send_command(timer):
     weapon=0
 
     # This is the structure fron CommandOrder
-    data=pack("iffffffiLiiifffi?i",
+    data=CommandOrder.pack(
         controllingid,
         thrust,
         roll,
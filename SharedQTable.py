@@ -0,0 +1,355 @@
+'''
+Shared memory Q-table.
+
+A Q-table that lives in multiprocessing.shared_memory, so the controllers
+of tank 1 and tank 2 (or any number of processes) learn on the same table
+at the same time, without one copy each and without the last writer
+overwriting the updates of the others.
+
+Same interface as QTable (row, argmax, max, update, take_dirty, ...), so
+it also works with Checkpointer and QTableFile.  Keys are ints (the packed
+states of StateDiscretizer).
+
+Layout of the shared block:
+
+    header   8 int64: magic, actions, capacity, hash slots, rows
+    slots    int64 [hash slots]          open addressing, row of the key or -1
+    keys     int64 [capacity]            key of every row, in insertion order
+    dirty    uint8 [capacity]            rows changed since the last take_dirty
+    values   float32 [capacity, actions]
+
+Rows are never removed.  A new key is written first and published in its
+slot last, so lookups do not lock: they either find the row or see an
+unseen state (all zeros).  When the table is full new states are not
+stored, they stay unseen states and their updates are lost (it is said
+once, the control loop goes on).  Inserts take one lock and updates take the
+lock of the stripe of their row (byte range locks on a lock file, they
+work between processes that were started separately).
+
+    python SharedQTable.py create name [q_table.qtab]
+    python SharedQTable.py save name q_table.qtab
+    python SharedQTable.py unlink name
+
+'''
+import fcntl
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from QTable import QTable
+from ActionTable import ActionTable
+import QTableFile
+
+MAGIC = 0x5154414253484d31   # 'QTABSHM1'
+HEADER = 8
+EMPTY = -1
+GOLDEN = 11400714819323198485
+MASK64 = (1 << 64) - 1
+
+
+class StripedLock:
+    # One lock per stripe, a byte of the lock file each.  The last byte is the insert lock.
+    def __init__(self, path, stripes=64):
+        self.path = path
+        self.stripes = stripes
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        # fcntl locks belong to the process, threads of the same process also need this one.
+        self.threadlock = threading.Lock()
+
+    @contextmanager
+    def stripe(self, i):
+        i = int(i) % self.stripes
+        with self.threadlock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, i)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, i)
+
+    @contextmanager
+    def inserting(self):
+        with self.threadlock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.stripes)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.stripes)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _size(n_actions, capacity, hashslots):
+    return 8 * HEADER + 8 * hashslots + 8 * capacity + _round8(capacity) + 4 * capacity * n_actions
+
+
+def _round8(n):
+    return (n + 7) // 8 * 8
+
+
+class SharedQTable:
+    def __init__(self, shm, locks):
+        self.shm = shm
+        self.locks = locks
+        self.chunk = 4096
+        self.full = False
+
+        buf = shm.buf
+        self.header = np.ndarray((HEADER,), dtype=np.int64, buffer=buf)
+        self.n_actions = int(self.header[1])
+        self.capacity = int(self.header[2])
+        self.hashslots = int(self.header[3])
+        self.hashbits = self.hashslots.bit_length() - 1
+
+        offset = 8 * HEADER
+        self.slots = np.ndarray((self.hashslots,), dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * self.hashslots
+        self.keyarray = np.ndarray((self.capacity,), dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * self.capacity
+        self.dirtymap = np.ndarray((self.capacity,), dtype=np.uint8, buffer=buf, offset=offset)
+        offset += _round8(self.capacity)
+        self.values = np.ndarray((self.capacity, self.n_actions), dtype=np.float32, buffer=buf, offset=offset)
+
+    @staticmethod
+    def _shm(name, create=False, size=0):
+        shm = shared_memory.SharedMemory(name, create=create, size=size)
+        # The table outlives the process that made it, unlink() removes it.
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+    @staticmethod
+    def lockpath(name):
+        return os.path.join(tempfile.gettempdir(), 'qtable-%s.lock' % name)
+
+    @classmethod
+    def create(cls, name, n_actions, capacity=1 << 17, stripes=64):
+        hashslots = 1 << (2 * capacity - 1).bit_length()
+        shm = cls._shm(name, create=True, size=_size(n_actions, capacity, hashslots))
+        header = np.ndarray((HEADER,), dtype=np.int64, buffer=shm.buf)
+        header[1:5] = n_actions, capacity, hashslots, 0
+        np.ndarray((hashslots,), dtype=np.int64, buffer=shm.buf, offset=8 * HEADER)[:] = EMPTY
+        # Published last, attach() waits for it.
+        header[0] = MAGIC
+        del header
+        return cls(shm, StripedLock(cls.lockpath(name), stripes))
+
+    @classmethod
+    def attach(cls, name, stripes=64, timeout=5.0):
+        shm = cls._shm(name)
+        header = np.ndarray((HEADER,), dtype=np.int64, buffer=shm.buf)
+        deadline = time.monotonic() + timeout
+        while header[0] != MAGIC:
+            if time.monotonic() > deadline:
+                del header
+                shm.close()
+                raise ValueError('Shared memory %s is not a Q-table.' % name)
+            time.sleep(0.01)
+        del header
+        return cls(shm, StripedLock(cls.lockpath(name), stripes))
+
+    @classmethod
+    def open(cls, name, n_actions, capacity=1 << 17, stripes=64):
+        '''Attaches to the table, or creates it when it does not exist yet.'''
+        try:
+            return cls.create(name, n_actions, capacity, stripes)
+        except FileExistsError:
+            table = cls.attach(name, stripes)
+            if table.n_actions != n_actions:
+                raise ValueError('Shared Q-table %s has %d actions, not %d.' % (name, table.n_actions, n_actions))
+            return table
+
+    @property
+    def n_rows(self):
+        return int(self.header[4])
+
+    @property
+    def keys(self):
+        return self.keyarray[:self.n_rows]
+
+    def __len__(self):
+        return self.n_rows
+
+    def __contains__(self, state):
+        return self._find(state)[0] >= 0
+
+    def __getitem__(self, state):
+        return self.row(state)
+
+    def _find(self, state):
+        # (row or -1, slot where it is or where it would go)
+        slot = ((int(state) * GOLDEN) & MASK64) >> (64 - self.hashbits)
+        mask = self.hashslots - 1
+        while True:
+            rowid = int(self.slots[slot])
+            if rowid == EMPTY or int(self.keyarray[rowid]) == state:
+                return rowid, slot
+            slot = (slot + 1) & mask
+
+    def row_id(self, state):
+        rowid, slot = self._find(state)
+        if rowid >= 0:
+            return rowid
+        with self.locks.inserting():
+            # Somebody else may have inserted it meanwhile.
+            rowid, slot = self._find(state)
+            if rowid >= 0:
+                return rowid
+            rowid = self.n_rows
+            if rowid >= self.capacity:
+                if not self.full:
+                    self.full = True
+                    print('Shared Q-table is full (%d rows), new states are not stored.' % self.capacity)
+                return EMPTY
+            self.keyarray[rowid] = state
+            self.header[4] = rowid + 1
+            self.slots[slot] = rowid
+        return rowid
+
+    def row_ids(self, states):
+        return np.fromiter((self._find(s)[0] for s in states), dtype=np.int64, count=len(states))
+
+    def row(self, state):
+        # This is a view on the shared memory (a throwaway row when the table is full).
+        rowid = self.row_id(state)
+        if rowid < 0:
+            return np.zeros(self.n_actions, dtype=self.values.dtype)
+        self.dirtymap[rowid] = 1
+        return self.values[rowid]
+
+    def argmax(self, state):
+        rowid = self._find(state)[0]
+        if rowid < 0:
+            return 0
+        return int(np.argmax(self.values[rowid]))
+
+    def argmax_many(self, states):
+        rows = self.row_ids(states)
+        actions = np.zeros(len(rows), dtype=np.int64)
+        seen = rows >= 0
+        if seen.any():
+            actions[seen] = np.argmax(self.values[rows[seen]], axis=1)
+        return actions
+
+    def max(self, state):
+        rowid = self._find(state)[0]
+        if rowid < 0:
+            return 0.0
+        return float(self.values[rowid].max())
+
+    def update(self, state, action, reward, next_state, learning_rate, discount_factor):
+        td_target = reward + discount_factor * self.max(next_state)
+        rowid = self.row_id(state)
+        if rowid < 0:
+            return td_target
+        with self.locks.stripe(rowid):
+            q = self.values[rowid]
+            td_error = td_target - q[action]
+            q[action] += learning_rate * td_error
+            self.dirtymap[rowid] = 1
+        return td_error
+
+    def add(self, state, delta):
+        # Like QTable.add, under the lock of the row so concurrent updates are not lost.
+        rowid = self.row_id(state)
+        if rowid < 0:
+            return
+        with self.locks.stripe(rowid):
+            self.values[rowid] += delta
+            self.dirtymap[rowid] = 1
+
+    def update_many(self, states, actions, rewards, next_states, learning_rate, discount_factor, weights=None):
+        # Same as QTable.update_many, each cell changes under the lock of its row.
+        states = np.asarray(states).tolist()
+        actions = np.asarray(actions, dtype=np.int64)
+        next_values = np.array([self.max(s) for s in np.asarray(next_states).tolist()], dtype=np.float64)
+        td_target = np.asarray(rewards, dtype=np.float64) + discount_factor * next_values
+
+        rows = np.array([self.row_id(s) for s in states], dtype=np.int64)
+        stored = rows >= 0
+        td_error = td_target.copy()
+        td_error[stored] -= self.values[rows[stored], actions[stored]]
+        weighted = td_error if weights is None else td_error * weights
+
+        # States that did not fit (table full) are not updated.
+        cells, inverse, counts = np.unique(rows[stored] * self.n_actions + actions[stored], return_inverse=True, return_counts=True)
+        change = learning_rate * np.bincount(inverse, weights=weighted[stored], minlength=len(cells)) / counts
+        for cell, delta in zip(cells.tolist(), change.tolist()):
+            rowid, action = divmod(cell, self.n_actions)
+            with self.locks.stripe(rowid):
+                self.values[rowid, action] += delta
+                self.dirtymap[rowid] = 1
+        return td_error
+
+    def items(self):
+        for rowid in range(self.n_rows):
+            yield int(self.keyarray[rowid]), self.values[rowid]
+
+    def take_dirty(self):
+        # Rows changed by any process since the last call (of any process).
+        with self.locks.inserting():
+            rows = np.flatnonzero(self.dirtymap[:self.n_rows]).astype(np.int64)
+            self.dirtymap[rows] = 0
+        return rows
+
+    def load(self, table):
+        # Copies every row of a QTable (or another table) into this one.
+        for state, values in table.items():
+            self.row(state)[:] = values
+
+    def snapshot(self):
+        # Private QTable copy, to save with QTableFile or use offline.
+        n = self.n_rows
+        return QTable.from_arrays(self.keyarray[:n].tolist(), self.values[:n].copy(), n, chunk=self.chunk)
+
+    def close(self):
+        # The numpy views must go before the memory can be closed.
+        del self.header, self.slots, self.keyarray, self.dirtymap, self.values
+        self.shm.close()
+        self.locks.close()
+
+    def unlink(self):
+        # SharedMemory.unlink unregisters it from the tracker again.
+        resource_tracker.register(self.shm._name, 'shared_memory')
+        self.shm.unlink()
+        try:
+            os.remove(self.lockpath(self.shm.name))
+        except OSError:
+            pass
+
+
+def terminator_grid():
+    # Action space of terminator.Controller, the default for a new table.
+    return ActionTable.grid(range(2), np.linspace(0, 2.5, 6), np.linspace(-2.5, 2.5, 11))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: python SharedQTable.py create|save|unlink name [q_table.qtab]')
+        sys.exit(1)
+
+    action, name = sys.argv[1], sys.argv[2]
+    path = sys.argv[3] if len(sys.argv) >= 4 else None
+
+    if action == 'create':
+        source = QTableFile.load(path) if path else None
+        table = SharedQTable.create(name, source.n_actions if source else len(terminator_grid()))
+        if source is not None:
+            table.load(source)
+        print('Shared Q-table %s: %d rows, %d actions, capacity %d' % (name, len(table), table.n_actions, table.capacity))
+        table.close()
+    elif action == 'save':
+        table = SharedQTable.attach(name)
+        QTableFile.write_full(path, table.keys, table.values[:table.n_rows], 1, table.n_rows + table.chunk)
+        print('%d rows saved to %s' % (len(table), path))
+        table.close()
+    elif action == 'unlink':
+        table = SharedQTable.attach(name)
+        table.close()
+        table.unlink()
+        print('Shared Q-table %s removed' % name)
@@ -0,0 +1,169 @@
+'''
+Stage Timer
+
+Per stage latency of the control loop (recv, decode, state, action,
+update, record, send), measured with perf_counter_ns and kept in
+histograms with log buckets (like HdrHistogram): every power of two is
+split in 2**subbits buckets, so recording is a couple of integer
+operations and the percentiles are within 1/2**subbits (12.5% with the
+default 3) of the real value, from nanoseconds to minutes in a few
+hundred counters.
+
+    timer = StageTimer()
+    timer.start()
+    ...
+    timer.lap('recv')      # time since start() or the last lap
+    ...
+    timer.lap('state')
+    timer.tick()           # dumps every interval seconds
+
+The table (count, p50, p99, max in microseconds) is printed every interval
+seconds and when the program exits.
+
+'''
+import atexit
+import sys
+import time
+
+
+class LatencyHistogram:
+    def __init__(self, subbits=3):
+        self.subbits = subbits
+        self.subcount = 1 << subbits
+        self.counts = [0] * (64 * self.subcount)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def bucket(self, value):
+        # Values below subcount have their own bucket, above that the top subbits+1 bits choose it.
+        shift = value.bit_length() - self.subbits - 1
+        if shift <= 0:
+            return value
+        return ((shift + 1) << self.subbits) + ((value >> shift) & (self.subcount - 1))
+
+    def upper(self, bucket):
+        # Highest value that goes into bucket.
+        if bucket < 2 * self.subcount:
+            return bucket
+        shift = (bucket >> self.subbits) - 1
+        return (((bucket & (self.subcount - 1)) + self.subcount + 1) << shift) - 1
+
+    def record(self, value):
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        rank = max(1, int(self.count * p / 100.0 + 0.5))
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.upper(bucket), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def clear(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+class StageTimer:
+    def __init__(self, stages=(), interval=10.0, name='Control loop', out=sys.stdout, reset=False):
+        self.name = name
+        self.interval = interval
+        self.out = out
+        # Clear the histograms after every periodic dump (only the last interval is shown).
+        self.reset = reset
+
+        self.histograms = {}
+        for stage in stages:
+            self.histograms[stage] = LatencyHistogram()
+
+        self.last = time.perf_counter_ns()
+        self.ticks = 0
+        self.lastdump = time.monotonic()
+
+        atexit.register(self.close)
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        return histogram
+
+    def start(self):
+        self.last = time.perf_counter_ns()
+
+    def lap(self, stage):
+        now = time.perf_counter_ns()
+        self.histogram(stage).record(now - self.last)
+        self.last = now
+
+    def add(self, stage, ns):
+        # For times measured somewhere else (another thread, another clock read).
+        self.histogram(stage).record(ns)
+
+    def tick(self):
+        self.ticks += 1
+        if self.interval and (self.ticks & 63) == 0 and time.monotonic() - self.lastdump > self.interval:
+            self.dump()
+            if self.reset:
+                for histogram in self.histograms.values():
+                    histogram.clear()
+
+    def report(self):
+        lines = ['%s latency, %d ticks (microseconds):' % (self.name, self.ticks),
+                 '  %-8s %9s %9s %9s %9s %9s' % ('stage', 'count', 'mean', 'p50', 'p99', 'max')]
+        for stage, h in self.histograms.items():
+            if h.count:
+                lines.append('  %-8s %9d %9.1f %9.1f %9.1f %9.1f' % (
+                    stage, h.count, h.mean() / 1000.0, h.percentile(50) / 1000.0,
+                    h.percentile(99) / 1000.0, h.max / 1000.0))
+        return '\n'.join(lines)
+
+    def dump(self):
+        self.lastdump = time.monotonic()
+        print(self.report(), file=self.out)
+
+    def close(self):
+        if self.ticks:
+            self.dump()
+        atexit.unregister(self.close)
+
+
+if __name__ == '__main__':
+    # Cost of one lap and accuracy of the percentiles.
+    import random
+    h = LatencyHistogram()
+    values = [int(random.expovariate(1 / 50000.0)) for _ in range(200000)]
+    for v in values:
+        h.record(v)
+    values.sort()
+    for p in (50, 90, 99, 99.9):
+        exact = values[int(len(values) * p / 100.0)]
+        print('p%-5s exact %8d  histogram %8d' % (p, exact, h.percentile(p)))
+
+    timer = StageTimer(('empty',), interval=0)
+    n = 200000
+    start = time.perf_counter_ns()
+    for _ in range(n):
+        timer.lap('empty')
+    print('lap: %.0f ns' % ((time.perf_counter_ns() - start) / n))
+    timer.close()
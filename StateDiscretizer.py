@@ -0,0 +1,128 @@
+'''
+State discretizer.
+
+The state is configured with a spec, a list of
+
+    (field, source, bins, (lo, hi))
+
+field   name of the state dimension.
+source  name of the input value (key of a dict, or field of a structured array).
+bins    a bin width (value // width), or a list of bin edges (np.searchsorted).
+lo, hi  clip range of the bin number, both included.
+
+Every bin number is clipped and packed into one integer (mixed radix), so the
+Q-table is keyed by a single int instead of a tuple.  The same object works
+on one tick (key) or on a whole recording at once (keys).
+
+'''
+import bisect
+import math
+
+import numpy as np
+
+
+class StateDiscretizer:
+    def __init__(self, spec, eps=0.000000001):
+        self.spec = list(spec)
+        self.fields = [s[0] for s in self.spec]
+        self.sources = [s[1] for s in self.spec]
+        self.eps = eps
+
+        n = len(self.spec)
+        self.lo = np.array([s[3][0] for s in self.spec], dtype=np.int64)
+        self.hi = np.array([s[3][1] for s in self.spec], dtype=np.int64)
+        self.radix = self.hi - self.lo + 1
+
+        if (self.radix <= 0).any():
+            raise ValueError('Empty clip range in state spec.')
+        if np.sum(np.log2(self.radix.astype(np.float64))) >= 63:
+            raise ValueError('State spec does not fit in a 64 bit key, reduce the clip ranges.')
+
+        # Fields with a bin width are computed all together, fields with edges one by one.
+        self.widthfields = np.array([i for i in range(n) if np.isscalar(self.spec[i][2])], dtype=np.intp)
+        self.widths = np.array([self.spec[i][2] for i in self.widthfields], dtype=np.float64)
+        self.edges = [(i, np.asarray(self.spec[i][2], dtype=np.float64)) for i in range(n) if not np.isscalar(self.spec[i][2])]
+
+        # Stride of each field inside the packed key, first field is the most significant.
+        self.strides = np.ones(n, dtype=np.int64)
+        for i in range(n - 2, -1, -1):
+            self.strides[i] = self.strides[i + 1] * self.radix[i + 1]
+
+        self.size = int(self.strides[0] * self.radix[0])
+
+        # Same rules in plain Python for key(), numpy costs more than the math on a single state.
+        self.scalarwidths = [(self.sources[i], float(self.spec[i][2]), int(self.lo[i]), int(self.hi[i]), int(self.strides[i]))
+                             for i in self.widthfields]
+        self.scalaredges = [(self.sources[i], edges.tolist(), int(self.lo[i]), int(self.hi[i]), int(self.strides[i]))
+                            for i, edges in self.edges]
+
+    def __len__(self):
+        return len(self.spec)
+
+    def bins(self, inputs):
+        # inputs can have scalars (one state) or arrays (many states) per source.
+        values = np.array([inputs[s] for s in self.sources], dtype=np.float64)
+        out = np.empty(values.shape, dtype=np.int64)
+
+        if len(self.widthfields):
+            w = self.widths.reshape((-1,) + (1,) * (values.ndim - 1))
+            out[self.widthfields] = np.floor((values[self.widthfields] + self.eps) / w)
+        for i, edges in self.edges:
+            out[i] = np.searchsorted(edges, values[i], side='right') - 1
+
+        lo = self.lo.reshape((-1,) + (1,) * (values.ndim - 1))
+        hi = self.hi.reshape((-1,) + (1,) * (values.ndim - 1))
+        return np.clip(out, lo, hi)
+
+    def pack(self, bins):
+        bins = np.asarray(bins, dtype=np.int64)
+        if bins.ndim == 1:
+            return int(np.dot(np.clip(bins, self.lo, self.hi) - self.lo, self.strides))
+        # One state per row
+        return (np.clip(bins, self.lo, self.hi) - self.lo) @ self.strides
+
+    def unpack(self, key):
+        key = int(key)
+        bins = []
+        for stride, lo, radix in zip(self.strides, self.lo, self.radix):
+            bins.append(int((key // stride) % radix + lo))
+        return tuple(bins)
+
+    def key(self, inputs):
+        key = 0
+        eps = self.eps
+        floor = math.floor
+        for source, width, lo, hi, stride in self.scalarwidths:
+            b = floor((float(inputs[source]) + eps) / width)
+            if b < lo:
+                b = lo
+            elif b > hi:
+                b = hi
+            key += (b - lo) * stride
+        for source, edges, lo, hi, stride in self.scalaredges:
+            b = min(max(bisect.bisect_right(edges, float(inputs[source])) - 1, lo), hi)
+            key += (b - lo) * stride
+        return key
+
+    def keys(self, inputs):
+        # Batch version, returns an int64 array with one key per recorded tick.
+        return self.pack(self.bins(inputs).T)
+
+
+# State used by terminator.py
+terminator_spec = [
+    ('bearing',        'bearing',        36,   (0, 9)),
+    ('distance',       'distance',       100,  (0, 63)),
+    ('turretbearing',  'turretbearing',  36,   (-8, 15)),
+    ('turretdecl',     'turretdecl',     10,   (0, 3)),
+    ('thrust',         'thrust',         3.33, (0, 3)),
+    ('steering',       'steering',       3,    (-20, 19)),
+    ('x',              'x',              100,  (-32, 31)),
+    ('z',              'z',              100,  (-32, 31)),
+    ('my_bearing',     'my_bearing',     36,   (0, 9)),
+    ('enemy_x',        'enemy_x',        100,  (-32, 31)),
+    ('enemy_z',        'enemy_z',        100,  (-32, 31)),
+    ('enemy_dx',       'enemy_dx',       1,    (-4, 3)),
+    ('enemy_dz',       'enemy_dz',       1,    (-4, 3)),
+    ('enemy_bearing',  'enemy_bearing',  36,   (0, 9)),
+]
@@ -0,0 +1,390 @@
+'''
+Headless Tank Duel Environment
+
+Many independent duels (one learning tank against one enemy) stepped all
+together as numpy arrays, without the simulator and without UDP, to train
+the terminator.py Q-table thousands of episodes at a time.
+
+Every duel reproduces what terminator.Controller does on each tick:
+
+- The turret locks on the enemy (lock_enemigo).
+- Far from the enemy (> 300) the tank approaches it (acercar_enemigo) and
+  close to it (< circledistance) it circles around it (circular_enemigo),
+  in between it keeps the last thrust and steering (Geometry.steer).
+- Every tick the policy picks an action (fire, turret declination,
+  bearing correction).  Up to maxinflight shots can wait for their
+  reward (like RewardScheduler), which comes delay ticks after firing:
+  the damage of that bullet times 20, or -50 when it missed.  When the
+  duel ends the shots in flight are resolved with what they did so far,
+  and bringing the enemy below 50 of health adds 5000 to the last shot.
+- The episode ends when the enemy is destroyed, the timer goes over
+  maxtimer or the power runs out, and the duel is reset right away.
+
+Movement and projectiles follow the same rules as FakeSimulator.
+
+The API is gym like, on all the duels at once:
+
+    obs = env.reset()
+    obs, reward, resolved, done, info = env.step(actions)
+
+obs is a dict of arrays with the inputs of StateDiscretizer.terminator_spec
+(so discretizer.keys(obs) gives the Q-table keys of every duel),
+actions are action ids of the ActionTable, one per duel.  Shots live in
+maxinflight slots per duel: reward and resolved are [duels, slots] and a
+reward belongs to the action chosen when that slot fired (info['fired']
+and info['slot'] tell when and where).
+
+    python TankEnv.py [duels] [ticks] [q_table.qtab]
+
+'''
+import os
+import sys
+import time
+
+import numpy as np
+
+from ActionTable import ActionTable
+import Geometry
+from QTable import QTable
+from StateDiscretizer import StateDiscretizer, terminator_spec
+import QTableFile
+
+
+def terminator_actions():
+    # Same action space as terminator.Controller: (fire, turretdecl, bearing correction)
+    return ActionTable.grid(range(2), np.linspace(0, 2.5, 6), np.linspace(-2.5, 2.5, 11))
+
+
+class TankEnv:
+    def __init__(self, n=1024, actions=None, spawndistance=(200.0, 1500.0), circledistance=100.0,
+                 enemythrust=(0.0, 5.0), enemysteering=(-5.0, 5.0), delay=150, maxtimer=4900, maxinflight=16,
+                 seed=None):
+        self.n = n
+        self.maxinflight = maxinflight
+        self.actions = terminator_actions() if actions is None else actions
+        self.spawndistance = spawndistance
+        self.circledistance = circledistance
+        self.enemythrust = enemythrust
+        self.enemysteering = enemysteering
+        self.delay = delay
+        self.maxtimer = maxtimer
+        self.random = np.random.RandomState(seed)
+
+        # Physics, like FakeSimulator
+        self.maxspeed = 2.0
+        self.turnrate = 0.2
+        self.bulletspeed = 20.0
+        self.bulletlife = 100
+        self.hitradius = 20.0
+        self.damage = 10.0
+
+        # Rewards, like terminator.Controller
+        self.hitreward = 20.0
+        self.missreward = -50.0
+        self.destroyreward = 5000.0
+
+        self.timer = np.zeros(n, dtype=np.int64)
+        self.x = np.zeros(n)
+        self.z = np.zeros(n)
+        self.bearing = np.zeros(n)
+        self.power = np.zeros(n, dtype=np.int64)
+
+        self.enemy_x = np.zeros(n)
+        self.enemy_z = np.zeros(n)
+        self.enemy_bearing = np.zeros(n)
+        self.enemy_health = np.zeros(n)
+        self.enemy_thrust = np.zeros(n)
+        self.enemy_steering = np.zeros(n)
+        self.prev_enemy_x = np.zeros(n)
+        self.prev_enemy_z = np.zeros(n)
+
+        # Last command of the behaviours (kept when no behaviour applies).
+        self.thrust = np.zeros(n)
+        self.steering = np.zeros(n)
+        self.behaviourbearing = np.zeros(n)
+        self.turretdecl = np.zeros(n)
+        self.bearing_corr = np.zeros(n)
+
+        # Shots, one slot each: projectile position, velocity and ticks left (0 is landed).
+        k = maxinflight
+        self.bullet_x = np.zeros((n, k))
+        self.bullet_z = np.zeros((n, k))
+        self.bullet_dx = np.zeros((n, k))
+        self.bullet_dz = np.zeros((n, k))
+        self.bullet_life = np.zeros((n, k))
+
+        # Shots waiting for their reward, the timer when it is due and the damage they did.
+        self.pending = np.zeros((n, k), dtype=bool)
+        self.due = np.zeros((n, k), dtype=np.int64)
+        self.damage_done = np.zeros((n, k))
+        self.lastslot = np.full(n, -1, dtype=np.int64)
+        # Duels with a free slot.
+        self.ready = np.ones(n, dtype=bool)
+
+        # Stats
+        self.episodes = 0
+        self.shots = 0
+        self.hits = 0
+        self.kills = 0
+
+        self.obs = None
+
+    def reset(self, mask=None):
+        '''Starts a new duel everywhere (or where mask is True) and returns the observation.'''
+        if mask is None:
+            mask = np.ones(self.n, dtype=bool)
+        idx = np.flatnonzero(mask)
+        k = len(idx)
+        r = self.random
+
+        self.timer[idx] = 0
+        self.x[idx] = r.uniform(-1500, 1500, k)
+        self.z[idx] = r.uniform(-1500, 1500, k)
+        self.bearing[idx] = r.uniform(0, 360, k)
+        self.power[idx] = 1000
+
+        angle = r.uniform(0, 2 * np.pi, k)
+        distance = r.uniform(self.spawndistance[0], self.spawndistance[1], k)
+        self.enemy_x[idx] = self.x[idx] + distance * np.cos(angle)
+        self.enemy_z[idx] = self.z[idx] + distance * np.sin(angle)
+        self.enemy_bearing[idx] = r.uniform(0, 360, k)
+        self.enemy_health[idx] = 100.0
+        self.enemy_thrust[idx] = r.uniform(self.enemythrust[0], self.enemythrust[1], k)
+        self.enemy_steering[idx] = r.uniform(self.enemysteering[0], self.enemysteering[1], k)
+        self.prev_enemy_x[idx] = self.enemy_x[idx]
+        self.prev_enemy_z[idx] = self.enemy_z[idx]
+
+        self.turretdecl[idx] = 0.0
+        self.bearing_corr[idx] = 0.0
+        self.bullet_life[idx] = 0
+        self.pending[idx] = False
+        self.damage_done[idx] = 0.0
+        self.lastslot[idx] = -1
+        self.ready[idx] = True
+
+        self.episodes += k
+
+        # Start approaching, terminator does not have a command before its first behaviour.
+        self.behaviourbearing[idx] = Geometry.bearing_to(self.x[idx], self.z[idx], self.enemy_x[idx], self.enemy_z[idx])
+        self.thrust[idx], self.steering[idx] = Geometry.approach(self.behaviourbearing[idx], self.bearing[idx])
+
+        self.obs = self._observe()
+        return self.obs
+
+    def _observe(self):
+        bearing, distance, turretbearing = Geometry.lock(self.x, self.z, self.bearing, self.enemy_x, self.enemy_z)
+        self.thrust, self.steering, self.behaviourbearing = Geometry.steer(
+            bearing, distance, self.bearing, self.thrust, self.steering, self.behaviourbearing,
+            circledistance=self.circledistance)
+
+        return {
+            'timer': self.timer.copy(),
+            'bearing': self.behaviourbearing.copy(),
+            'distance': distance,
+            'turretbearing': turretbearing,
+            'turretdecl': np.zeros(self.n),
+            'thrust': self.thrust.copy(),
+            'steering': self.steering.copy(),
+            'x': self.x.copy(),
+            'z': self.z.copy(),
+            'my_bearing': self.bearing.copy(),
+            'enemy_x': self.enemy_x.copy(),
+            'enemy_z': self.enemy_z.copy(),
+            'enemy_dx': self.prev_enemy_x - self.enemy_x,
+            'enemy_dz': self.prev_enemy_z - self.enemy_z,
+            'enemy_bearing': self.enemy_bearing.copy(),
+            'enemy_health': self.enemy_health.copy()}
+
+    def step(self, actions):
+        '''
+        Runs one tick of every duel with the given action ids and moves on to
+        the next one.  Returns (obs, reward, resolved, done, info).
+        '''
+        obs = self.obs
+        chosen = self.actions.array[np.asarray(actions, dtype=np.int64)]
+        self.turretdecl[:] = chosen[:, 1]
+        self.bearing_corr[:] = chosen[:, 2]
+
+        # Fire where there is a free slot.
+        fired = (chosen[:, 0] == 1) & self.ready
+        slot = np.argmin(self.pending, axis=1)
+        if fired.any():
+            self._shoot(fired, slot, obs['turretbearing'])
+
+        # Delayed rewards, the shots due at this timer, and every shot in flight where the duel ends.
+        destroyed = self.enemy_health < 50
+        done = destroyed | (self.timer > self.maxtimer) | (self.power < 10)
+        resolved = self.pending & ((self.due <= self.timer[:, None]) | done[:, None])
+        reward = np.zeros(self.pending.shape)
+        reward[resolved] = np.where(self.damage_done[resolved] > 0, self.damage_done[resolved] * self.hitreward, self.missreward)
+        self.hits += int(np.count_nonzero(resolved & (self.damage_done > 0)))
+        self.pending[resolved] = False
+        self.damage_done[resolved] = 0.0
+
+        # End of the episode, on top of what the last shot did.
+        killers = np.flatnonzero(destroyed & (self.lastslot >= 0))
+        reward[killers, self.lastslot[killers]] += self.destroyreward
+        resolved[killers, self.lastslot[killers]] = True
+        self.kills += int(np.count_nonzero(destroyed))
+
+        self._move()
+        self.ready = ~self.pending.all(axis=1)
+
+        info = {'fired': fired, 'slot': slot, 'destroyed': destroyed}
+        if done.any():
+            self.reset(done)
+        else:
+            self.obs = self._observe()
+        return self.obs, reward, resolved, done, info
+
+    def _shoot(self, fired, slot, turretbearing):
+        # The turret points to bearing + turretbearing - 180, that is the enemy plus the correction.
+        rows = np.flatnonzero(fired)
+        slots = slot[rows]
+        aim = np.radians(self.bearing[rows] + turretbearing[rows] + self.bearing_corr[rows] - 180)
+        self.bullet_x[rows, slots] = self.x[rows]
+        self.bullet_z[rows, slots] = self.z[rows]
+        self.bullet_dx[rows, slots] = self.bulletspeed * np.sin(aim)
+        self.bullet_dz[rows, slots] = -self.bulletspeed * np.cos(aim)
+        self.bullet_life[rows, slots] = self.bulletlife * (1 + self.turretdecl[rows] / 10.0)
+
+        self.power[rows] -= 1
+        self.pending[rows, slots] = True
+        self.due[rows, slots] = self.timer[rows] + self.delay
+        self.damage_done[rows, slots] = 0.0
+        self.lastslot[rows] = slots
+        self.shots += len(rows)
+
+    def _move(self):
+        self.prev_enemy_x[:] = self.enemy_x
+        self.prev_enemy_z[:] = self.enemy_z
+
+        # Tanks move towards bearing + 180.
+        self.bearing = (self.bearing + self.steering * self.turnrate) % 360
+        heading = np.radians(self.bearing + 180)
+        speed = np.clip(self.thrust, -10, 10) / 10.0 * self.maxspeed
+        self.x += speed * np.sin(heading)
+        self.z -= speed * np.cos(heading)
+
+        self.enemy_bearing = (self.enemy_bearing + self.enemy_steering * self.turnrate) % 360
+        heading = np.radians(self.enemy_bearing + 180)
+        speed = self.enemy_thrust / 10.0 * self.maxspeed
+        self.enemy_x += speed * np.sin(heading)
+        self.enemy_z -= speed * np.cos(heading)
+
+        flying = self.bullet_life > 0
+        if flying.any():
+            self.bullet_x[flying] += self.bullet_dx[flying]
+            self.bullet_z[flying] += self.bullet_dz[flying]
+            self.bullet_life[flying] -= 1
+            hit = flying & (np.hypot(self.bullet_x - self.enemy_x[:, None], self.bullet_z - self.enemy_z[:, None]) < self.hitradius)
+            if hit.any():
+                # Every bullet knows its shot, the damage goes to that slot.
+                health = self.enemy_health.copy()
+                self.enemy_health = np.maximum(0.0, self.enemy_health - self.damage * hit.sum(axis=1))
+                rows, slots = np.nonzero(hit)
+                self.damage_done[rows, slots] += np.minimum(self.damage, health[rows])
+                self.bullet_life[hit] = 0
+
+        self.timer += 1
+
+
+class TableAgent:
+    '''
+    The learning part of terminator.Controller (same table, actions, state and
+    parameters) without the sockets, plus a batch choose_actions for TankEnv.
+    '''
+    def __init__(self, q_table=None, actions=None, discretizer=None):
+        self.learning_rate = 0.1
+        self.discount_factor = 0.2
+        self.epsilon = 0.02
+
+        self.acciones = terminator_actions() if actions is None else actions
+        self.q_table = QTable(len(self.acciones)) if q_table is None else q_table
+        self.discretizer = StateDiscretizer(terminator_spec) if discretizer is None else discretizer
+
+    def choose_action(self, state):
+        if np.random.rand() < self.epsilon:
+            return self.acciones.random_id()
+        return self.q_table.argmax(state)
+
+    def choose_actions(self, states):
+        actions = self.q_table.argmax_many(states)
+        explore = np.random.rand(len(actions)) < self.epsilon
+        actions[explore] = np.random.randint(len(self.acciones), size=int(np.count_nonzero(explore)))
+        return actions
+
+    def update_q_table(self, state, action, reward, next_state):
+        return self.q_table.update(state, action, reward, next_state, self.learning_rate, self.discount_factor)
+
+
+class Trainer:
+    '''
+    Runs an agent on every duel of env, learning from each shot when its
+    reward is known.  The agent needs discretizer, choose_action and
+    update_q_table like terminator.Controller (choose_actions is used when
+    it has it).  run() can be called many times, the duels and the pending
+    shots go on from where they were.
+    '''
+    def __init__(self, env, agent):
+        self.env = env
+        self.agent = agent
+        self.choose_actions = getattr(agent, 'choose_actions', None)
+
+        self.obs = env.reset()
+        self.shotstate = np.zeros((env.n, env.maxinflight), dtype=np.int64)
+        self.shotaction = np.zeros((env.n, env.maxinflight), dtype=np.int64)
+
+        self.ticks = 0
+        self.updates = 0
+
+    def run(self, ticks):
+        env, agent = self.env, self.agent
+        total = 0.0
+
+        for _ in range(ticks):
+            states = agent.discretizer.keys(self.obs)
+            if self.choose_actions is not None:
+                actions = self.choose_actions(states.tolist())
+            else:
+                actions = np.array([agent.choose_action(s) for s in states.tolist()], dtype=np.int64)
+
+            self.obs, reward, resolved, done, info = env.step(actions)
+
+            fired = np.flatnonzero(info['fired'])
+            slots = info['slot'][fired]
+            self.shotstate[fired, slots] = states[fired]
+            self.shotaction[fired, slots] = actions[fired]
+            for i, slot in zip(*np.nonzero(resolved)):
+                # Next state is the one of the tick the reward came, like terminator.
+                agent.update_q_table(int(self.shotstate[i, slot]), int(self.shotaction[i, slot]), float(reward[i, slot]), int(states[i]))
+                total += reward[i, slot]
+                self.updates += 1
+
+        self.ticks += ticks
+        return total
+
+
+def train(env, agent, ticks):
+    # Runs ticks steps on fresh duels, returns the total reward.
+    return Trainer(env, agent).run(ticks)
+
+
+if __name__ == '__main__':
+    duels = int(sys.argv[1]) if len(sys.argv) >= 2 else 1024
+    ticks = int(sys.argv[2]) if len(sys.argv) >= 3 else 5000
+    path = sys.argv[3] if len(sys.argv) >= 4 else None
+
+    env = TankEnv(duels)
+    agent = TableAgent(QTableFile.load(path) if path and os.path.exists(path) else None)
+
+    start = time.perf_counter()
+    total = train(env, agent, ticks)
+    elapsed = time.perf_counter() - start
+
+    print('%d duels x %d ticks in %.1f s: %.0f duel ticks per second' % (duels, ticks, elapsed, duels * ticks / elapsed))
+    print('Episodes: %d, shots: %d, hits: %d, kills: %d, total reward: %.0f, states: %d' % (
+        env.episodes, env.shots, env.hits, env.kills, total, len(agent.q_table)))
+    if path:
+        QTableFile.save(agent.q_table, path)
+        print('Q-table saved to %s' % path)
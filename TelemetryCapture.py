@@ -0,0 +1,192 @@
+'''
+Telemetry Capture and Replay
+
+Capture keeps every telemetry datagram as it came (the whole ModelRecord,
+not only some columns like ./data/sensor.*.dat) with the port and the
+receive time, appended to a compact binary file:
+
+    header   16 bytes: magic 'TCAP', version, reserved
+    entries  int64 receive time (monotonic ns), uint16 port, uint16 length, data
+
+Replay sends them again over UDP to the controller ports (4601, 4602) in
+the same order, in real time, faster or slower (speed), or as fast as
+possible (speed 0), so controller throughput can be measured with exactly
+the same input every time.
+
+    python TelemetryCapture.py capture telemetry.tcap [ports, default 4601 4602]
+    python TelemetryCapture.py replay telemetry.tcap [speed, default 1] [ip]
+
+A controller can also capture what it receives while it runs, setting
+TelemetryIngest.capture to a CaptureWriter (the receive time is then the
+one of the wakeup).
+
+'''
+import select
+import socket
+import struct
+import sys
+import time
+
+import numpy as np
+
+from Protocol import ModelRecord
+
+MAGIC = b'TCAP'
+VERSION = 1
+fileheader = struct.Struct('<4sII4x')
+entryheader = struct.Struct('<qHH')
+
+
+class CaptureWriter:
+    def __init__(self, filename, buffersize=1 << 20):
+        self.filename = filename
+        self.f = open(filename, 'wb', buffering=buffersize)
+        self.f.write(fileheader.pack(MAGIC, VERSION, 0))
+        self.entries = 0
+        self.bytes = fileheader.size
+
+    def write(self, port, data, received=None):
+        if received is None:
+            received = time.monotonic_ns()
+        self.f.write(entryheader.pack(received, port, len(data)))
+        self.f.write(data)
+        self.entries += 1
+        self.bytes += entryheader.size + len(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def read_capture(filename):
+    '''Yields (receive time ns, port, data) of every captured datagram.'''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, _ = fileheader.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a telemetry capture: ' + filename)
+
+    view = memoryview(data)
+    offset = fileheader.size
+    # A capture cut while writing ends with a partial entry, it is ignored.
+    while offset + entryheader.size <= len(data):
+        received, port, length = entryheader.unpack_from(data, offset)
+        offset += entryheader.size
+        if offset + length > len(data):
+            break
+        yield received, port, view[offset:offset + length]
+        offset += length
+
+
+def load_records(filename, wireformat=ModelRecord):
+    # (times, ports, structured array of records), for the offline tools.
+    times, ports, records = [], [], []
+    for received, port, data in read_capture(filename):
+        if len(data) == wireformat.size:
+            times.append(received)
+            ports.append(port)
+            records.append(bytes(data))
+    return (np.array(times, dtype=np.int64), np.array(ports, dtype=np.uint16),
+            wireformat.decode(b''.join(records)))
+
+
+def capture(filename, ports=(4601, 4602), ip='0.0.0.0', timeout=5):
+    '''Listens on the ports and writes everything until nothing arrives for timeout seconds.'''
+    socks = {}
+    for port in ports:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.bind((ip, port))
+        sock.setblocking(False)
+        socks[sock] = port
+
+    writer = CaptureWriter(filename)
+    buffer = bytearray(65536)
+    try:
+        while True:
+            readable, _, _ = select.select(list(socks), [], [], timeout)
+            if not readable:
+                break
+            for sock in readable:
+                while True:
+                    try:
+                        size = sock.recv_into(buffer)
+                    except BlockingIOError:
+                        break
+                    writer.write(socks[sock], buffer[:size])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        for sock in socks:
+            sock.close()
+    return writer.entries
+
+
+class Replay:
+    def __init__(self, filename, ip='127.0.0.1', ports=None, speed=1.0):
+        '''ports maps captured port -> port to send to (default, the same).'''
+        self.entries = list(read_capture(filename))
+        self.ip = ip
+        self.ports = ports or {}
+        self.speed = speed
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # Stats
+        self.sent = 0
+        self.late = 0
+        self.maxlateness = 0.0
+        self.elapsed = 0.0
+
+    def run(self):
+        if not self.entries:
+            return 0
+        addresses = {}
+        first = self.entries[0][0]
+        start = time.perf_counter()
+        for received, port, data in self.entries:
+            if self.speed:
+                due = start + (received - first) / 1e9 / self.speed
+                delay = due - time.perf_counter()
+                if delay > 0.0005:
+                    time.sleep(delay - 0.0005)
+                while time.perf_counter() < due:
+                    pass
+                lateness = time.perf_counter() - due
+                if lateness > 0.001:
+                    self.late += 1
+                    self.maxlateness = max(self.maxlateness, lateness)
+            address = addresses.get(port)
+            if address is None:
+                address = addresses[port] = (self.ip, self.ports.get(port, port))
+            self.sock.sendto(data, address)
+            self.sent += 1
+        self.elapsed = time.perf_counter() - start
+        return self.sent
+
+    def close(self):
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('capture', 'replay'):
+        print('Usage: python TelemetryCapture.py capture file [ports] | replay file [speed] [ip]')
+        sys.exit(1)
+
+    if sys.argv[1] == 'capture':
+        ports = [int(p) for p in sys.argv[3:]] or [4601, 4602]
+        print('Capturing ports %s into %s' % (ports, sys.argv[2]))
+        n = capture(sys.argv[2], ports)
+        print('%d datagrams captured.' % n)
+    else:
+        speed = float(sys.argv[3]) if len(sys.argv) >= 4 else 1.0
+        ip = sys.argv[4] if len(sys.argv) >= 5 else '127.0.0.1'
+        replay = Replay(sys.argv[2], ip, speed=speed)
+        replay.run()
+        replay.close()
+        print('%d datagrams in %.2f s (%.0f per second), %d late (max %.1f ms)' % (
+            replay.sent, replay.elapsed, replay.sent / max(replay.elapsed, 1e-9), replay.late, replay.maxlateness * 1000))
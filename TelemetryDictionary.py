@@ -1,21 +1,27 @@
-telemetrydirs = {
-  'timer':0,
-  'number':1,
-  'health':2,
-  'power':3,
-  'bearing':4,
-  'x':5,
-  'y':6,
-  'z':7,
-  'R1':8,
-  'R2':9,
-  'R3':10,
-  'R4':11,
-  'R5':12,
-  'R6':13,
-  'R7':14,
-  'R8':15,
-  'R9':16,
-  'R10':17,
-  'R11':18,
-  'R12':19}
+import numpy as np
+
+from Protocol import ModelRecord
+
+# Position of each field in the unpacked ModelRecord tuple.
+telemetrydirs = dict(ModelRecord.index)
+
+telemetrynames = ModelRecord.names
+unpackcode = ModelRecord.code
+length = ModelRecord.size
+
+# numpy view of a ModelRecord, same layout as unpackcode.
+telemetrydtype = ModelRecord.dtype
+
+
+def decode(buffer):
+    '''
+    Many ModelRecords one after the other (bytes, bytearray, memoryview) to
+    a structured array.  No copy, the array is a view of the buffer, so copy
+    it if the buffer is going to be reused.
+    '''
+    return ModelRecord.decode(buffer)
+
+
+def load_dump(filename):
+    # A file with raw ModelRecords back to back, memory mapped.
+    return np.memmap(filename, dtype=telemetrydtype, mode='r')
@@ -0,0 +1,184 @@
+'''
+Telemetry Ingest
+
+The simulator sends one ModelRecord per tank per tick.  Instead of one
+blocking recvfrom per record (and assuming tank 1 always comes before
+tank 2), every wakeup drains all the datagrams waiting on the socket into
+one buffer, decodes them together and groups them by timer into frames.
+
+A frame is a dict tank number -> record, it is complete when it has a
+record of every tank.  Frames older than the newest complete one can not
+be completed anymore and are dropped.  Records of other tanks are ignored.
+A record at or behind the last frame is late and dropped, unless it is far
+behind (more than maxpending ticks) or at the start of the timer: then the
+simulator started a new episode.
+
+'''
+import select
+import socket
+import time
+
+from Protocol import ModelRecord
+
+
+class FrameAssembler:
+    def __init__(self, tanks=(1, 2), timerfield=0, numberfield=1, maxpending=16, starttimer=1):
+        self.tanks = tuple(tanks)
+        self.tankset = frozenset(self.tanks)
+        self.timerfield = timerfield
+        self.numberfield = numberfield
+        self.maxpending = maxpending
+        # Timers up to this one begin an episode.
+        self.starttimer = starttimer
+
+        # timer -> {number: record}
+        self.pending = {}
+        self.lasttimer = -1
+
+        self.frames = 0
+        self.dropped = 0
+        self.ignored = 0
+        self.late = 0
+        self.resets = 0
+
+    def add(self, records):
+        '''Adds decoded records, returns the frames completed, oldest first.'''
+        completed = []
+        for record in records:
+            number = int(record[self.numberfield])
+            if number not in self.tankset:
+                self.ignored += 1
+                continue
+            timer = record[self.timerfield]
+            if timer <= self.lasttimer:
+                if timer < self.lasttimer - self.maxpending or (timer <= self.starttimer < self.lasttimer - 1):
+                    # The simulator restarted the timer (reset, command 13).
+                    # Frames of the old episode that were not complete are dropped.
+                    self.pending = {}
+                    self.lasttimer = -1
+                    self.resets += 1
+                else:
+                    # A frame for this tick was already delivered (or given up).
+                    self.late += 1
+                    continue
+            frame = self.pending.setdefault(timer, {})
+            isnew = number not in frame
+            frame[number] = record
+            if isnew and len(frame) == len(self.tanks):
+                completed.append((timer, frame))
+
+        if not completed:
+            if len(self.pending) > self.maxpending:
+                self._discard(sorted(self.pending)[len(self.pending) - self.maxpending - 1])
+            return []
+
+        completed.sort(key=lambda c: c[0])
+        self._discard(completed[-1][0])
+        self.frames += len(completed)
+        return [frame for timer, frame in completed]
+
+    def _discard(self, timer):
+        # Forget every frame up to timer (included).
+        for t in [t for t in self.pending if t <= timer]:
+            frame = self.pending.pop(t)
+            if len(frame) < len(self.tanks):
+                self.dropped += 1
+        self.lasttimer = max(self.lasttimer, timer)
+
+
+class TelemetryIngest:
+    def __init__(self, port, tanks=(1, 2), wireformat=ModelRecord, batch=64, timeout=5, ip='0.0.0.0'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.server_address = (ip, port)
+        self.sock.bind(self.server_address)
+        self.sock.setblocking(False)
+
+        self.wireformat = wireformat
+        self.length = wireformat.size
+        self.codec = wireformat.struct
+        self.batch = batch
+        self.timeout = timeout
+
+        # One byte more than the batch, so a datagram longer than a record shows up as length + 1.
+        self.buffer = bytearray(self.length * batch + 1)
+        self.view = memoryview(self.buffer)
+
+        self.assembler = FrameAssembler(tanks)
+        self.ready = []
+
+        # Optional StageTimer, gets the recv and decode times of every wakeup.
+        self.timer = None
+        # Optional TelemetryCapture.CaptureWriter, gets every valid datagram.
+        self.capture = None
+
+        # Stats
+        self.wakeups = 0
+        self.datagrams = 0
+        self.invalid = 0
+
+    def _receive(self):
+        # Datagrams waiting on the socket go one after the other in the buffer.
+        # Reading length + 1 bytes tells the records from the longer datagrams (dropped, not truncated).
+        n = 0
+        while n < self.batch:
+            try:
+                size = self.sock.recv_into(self.view[n * self.length:], self.length + 1)
+            except BlockingIOError:
+                break
+            if size == self.length:
+                n += 1
+            else:
+                self.invalid += 1
+        self.datagrams += n
+        if self.capture is not None and n:
+            received = time.monotonic_ns()
+            for i in range(n):
+                self.capture.write(self.server_address[1], self.view[i * self.length:(i + 1) * self.length], received)
+        return n
+
+    def drain(self):
+        '''Reads everything that is waiting on the socket, returns the decoded records.'''
+        n = self._receive()
+        return list(self.codec.iter_unpack(self.view[:n * self.length]))
+
+    def drain_array(self):
+        '''Like drain, but the records come as a numpy structured array (a copy).'''
+        n = self._receive()
+        return self.wireformat.decode(self.view[:n * self.length]).copy()
+
+    def poll(self, timeout=None):
+        '''Waits for data and returns the frames that got completed (maybe none).'''
+        if timeout is None:
+            timeout = self.timeout
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            raise socket.timeout('No telemetry received in %s seconds' % timeout)
+        self.wakeups += 1
+        if self.timer is None:
+            return self.assembler.add(self.drain())
+
+        start = time.perf_counter_ns()
+        n = self._receive()
+        received = time.perf_counter_ns()
+        frames = self.assembler.add(list(self.codec.iter_unpack(self.view[:n * self.length])))
+        self.timer.add('recv', received - start)
+        self.timer.add('decode', time.perf_counter_ns() - received)
+        return frames
+
+    def next_frame(self):
+        '''Blocks until there is a complete frame and returns the oldest one not used yet.'''
+        while not self.ready:
+            self.ready = self.poll()
+        return self.ready.pop(0)
+
+    def latest_frame(self):
+        # Like next_frame, but skips the older frames that are waiting.
+        frame = self.next_frame()
+        if self.ready:
+            frame = self.ready[-1]
+            self.ready = []
+        return frame
+
+    def close(self):
+        self.sock.close()
@@ -2,6 +2,7 @@ import socket
 from struct import *
 import datetime, time
 from TelemetryDictionary import telemetrydirs as td
+from Protocol import ModelRecord
 import sys
 
 import math
@@ -26,8 +27,8 @@ class Controller:
         self.sock.bind(self.server_address)
         self.sock.settimeout(5)
 
-        self.length = 84
-        self.unpackcode = 'Lififfffffffffffffff'
+        self.length = ModelRecord.size
+        self.unpackcode = ModelRecord.code
 
         self.recorder = Recorder()
 
@@ -42,7 +43,7 @@ class Controller:
         # Take care of the latency
         if len(data)>0 and len(data) == self.length:
             # is  a valid message struct
-            new_values = unpack(self.unpackcode,data)
+            new_values = ModelRecord.unpack(data)
             return new_values
         
         return None
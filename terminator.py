@@ -1,41 +1,51 @@
 import socket
-from struct import unpack
-import datetime, time
 import sys
-import math
 import numpy as np
-import pickle
-import random
-from collections import defaultdict, deque
+import os
 
-from Command import Command
-from Command import Recorder
+from Command import CommandChannel
+from Command import BinaryRecorder
 from TelemetryDictionary import telemetrydirs as td
-
-def default_q_value():
-    return np.zeros(len(range(2)) * len(range(6)) * len(range(-5, 6)))  # Espacio de acciones combinadas
+from Protocol import ModelRecord
+from QTable import QTable, load_pickle
+from SharedQTable import SharedQTable
+from Checkpointer import Checkpointer
+import QTableFile
+from ActionTable import ActionTable
+from StateDiscretizer import StateDiscretizer, terminator_spec
+import Geometry
+from TelemetryIngest import TelemetryIngest
+from FrameRing import FrameReceiver
+from StageTimer import StageTimer
+from ReplayBuffer import ReplayBuffer
+from RewardScheduler import RewardScheduler, flight_window
 
 class Controller:
-    def __init__(self, tankparam, load_q_table=False):
+    def __init__(self, tankparam, load_q_table=False, shared=None):
         # UDP Telemetry port on port 4500
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         tankparam = int(tankparam)
         port = 4601 if tankparam == 1 else 4602
-        self.server_address = ('0.0.0.0', port)
-        print('Starting up on %s port %s' % self.server_address)
 
-        self.sock.bind(self.server_address)
-        self.sock.settimeout(5)
+        self.length = ModelRecord.size
+        self.unpackcode = ModelRecord.code
+
+        self.ingest = TelemetryIngest(port, tanks=(1, 2), timeout=5)
+
+        # Where the tick goes, printed every 10 s and at exit.
+        self.timer = StageTimer(('recv', 'decode', 'wait', 'state', 'action', 'update', 'record', 'episode', 'send', 'replay'),
+                                name='Tank %d control loop' % tankparam)
+        self.ingest.timer = self.timer
+        self.server_address = self.ingest.server_address
+        print('Starting up on %s port %s' % self.server_address)
 
-        self.length = 84
-        self.unpackcode = 'Lififfffffffffffffff'
+        # Receives in its own thread, read() always gets the newest tick.
+        self.receiver = FrameReceiver(self.ingest)
 
-        self.recorder = Recorder()
         self.tank = tankparam
+        self.recorder = BinaryRecorder(tank=tankparam)
         self.previous_fire_angle = -3
 
         # Q-learning parameters
-        self.q_table = defaultdict(default_q_value)
         self.learning_rate = 0.1
         self.discount_factor = 0.2
         self.epsilon = 0.02
@@ -45,60 +55,64 @@ class Controller:
         self.prev_z_enemy = 0
 
         # Define the combined action space
-        self.acciones = [(disparo, decl, bearing_corr) for disparo in range(2) for decl in np.linspace(0,2.5,6) for bearing_corr in np.linspace(-2.5, 2.5,11)]
+        self.acciones = ActionTable.grid(range(2), np.linspace(0,2.5,6), np.linspace(-2.5, 2.5,11))
+        self.q_table = QTable(len(self.acciones))
+        self.discretizer = StateDiscretizer(terminator_spec)
 
-        self.delayed_rewards = deque()  # Cola para manejar recompensas diferidas
-        self.waiting_for_result = False  # Indicador de estado de disparo
+        # Recompensas diferidas: many shots in flight, each one resolved 150 simulator ticks later.
+        self.rewards = RewardScheduler(delay=150, maxinflight=16)
+
+        # Resolved shots are learned again between ticks, hits and surprises more often.
+        self.replay = ReplayBuffer(capacity=1 << 14)
+        self.replay_batch = 32
+        self.replay_ratio = 32      # samples replayed per new shot
+        self.replay_budget = 0.001  # seconds per tick, upper bound
+
+        # Each tank has its own file, unless they share the table (then tank 1 writes q_table.qtab).
+        self.qtabpath = 'q_table.qtab' if shared or self.tank == 1 else 'q_table.%d.qtab' % self.tank
 
         if load_q_table:
-            with open('q_table.pkl', 'rb') as f:
-                self.q_table = pickle.load(f)
-                print("Q-table loaded successfully.")
+            if os.path.exists(self.qtabpath):
+                self.q_table = QTableFile.load(self.qtabpath)
+            else:
+                self.q_table = load_pickle('q_table.pkl', self.discretizer)
+            if self.q_table.n_actions != len(self.acciones):
+                print("Q-table has %d actions instead of %d, starting a new one." % (self.q_table.n_actions, len(self.acciones)))
+                self.q_table = QTable(len(self.acciones))
+            print("Q-table loaded successfully: %d states." % len(self.q_table))
+
+        if shared:
+            # Both tanks learn on the same table in shared memory, only tank 1 writes the file.
+            table = SharedQTable.open(shared, len(self.acciones))
+            if len(table) == 0 and len(self.q_table):
+                table.load(self.q_table)
+            self.q_table = table
+            print("Shared Q-table %s: %d states." % (shared, len(table)))
+
+        self.checkpointer = None
+        if not shared or self.tank == 1:
+            self.checkpointer = Checkpointer(self.q_table, self.qtabpath)
 
     def read(self):
-        data, address = self.sock.recvfrom(self.length)
-        if len(data) > 0 and len(data) == self.length:
-            new_values = unpack(self.unpackcode, data)
-            return new_values
-        return None
-
-    def lock_enemigo(self, myvalues, othervalues):
-        vec2d = (float(myvalues[td['x']]), float(myvalues[td['z']]))
-        ## enemy tank position
-        vec2d_enemy = (float(othervalues[td['x']]), float(othervalues[td['z']]))
-
-        # bearing to enemy
-        bearing = math.degrees(math.atan2(vec2d_enemy[1]-vec2d[1], vec2d_enemy[0]-vec2d[0]))
-        
-        bearing = (bearing + 360) % 360
-        bearing = (bearing + 90) % 360
-        
-        turretbearing = bearing - myvalues[td['bearing']] + 180
-        
-        return turretbearing
-    
-    def acercar_enemigo(self, myvalues, othervalues, command):
-        vec2d = (float(myvalues[td['x']]), float(myvalues[td['z']]))
-        ## enemy tank position
-        vec2d_enemy = (float(othervalues[td['x']]), float(othervalues[td['z']]))
+        # Newest complete tick, (tank 1 record, tank 2 record), whatever the order they arrived.
+        frame = self.receiver.latest()
+        return frame[1], frame[2]
 
-        # bearing to enemy
-        bearing = math.degrees(math.atan2(vec2d_enemy[1]-vec2d[1], vec2d_enemy[0]-vec2d[0]))
-        
-        bearing = (bearing + 360) % 360
-        bearing = (bearing + 90) % 360
-        
-        if bearing > 180:
-            steering = bearing - myvalues[td['bearing']] - 180
-        else:   
-            steering = bearing - myvalues[td['bearing']] + 180
+    def enemy_bearing(self, myvalues, othervalues):
+        # bearing to enemy, computed once per tick and shared by the behaviours
+        return Geometry.bearing_to_scalar(float(myvalues[td['x']]), float(myvalues[td['z']]), float(othervalues[td['x']]), float(othervalues[td['z']]))
+
+    def lock_enemigo(self, myvalues, othervalues, bearing=None):
+        if bearing is None:
+            bearing = self.enemy_bearing(myvalues, othervalues)
+
+        return Geometry.turret_bearing_scalar(bearing, float(myvalues[td['bearing']]))
     
-        steering = np.clip(steering, -15, 15)
-        
-        if abs(steering) >= 15:
-            thrust = 3.0
-        else:
-            thrust = 10.0
+    def acercar_enemigo(self, myvalues, othervalues, command, bearing=None):
+        if bearing is None:
+            bearing = self.enemy_bearing(myvalues, othervalues)
+
+        thrust, steering = Geometry.approach_scalar(bearing, float(myvalues[td['bearing']]))
         
         # last_fire_angle = bearing
         # angle_difference = abs(last_fire_angle - self.previous_fire_angle) 
@@ -110,29 +124,11 @@ class Controller:
 
         return thrust, steering, bearing
     
-    def circular_enemigo(self, myvalues, othervalues, command):
-        vec2d = (float(myvalues[td['x']]), float(myvalues[td['z']]))
-        ## enemy tank position
-        vec2d_enemy = (float(othervalues[td['x']]), float(othervalues[td['z']]))
+    def circular_enemigo(self, myvalues, othervalues, command, bearing=None):
+        if bearing is None:
+            bearing = self.enemy_bearing(myvalues, othervalues)
 
-        # bearing to enemy
-        bearing = math.degrees(math.atan2(vec2d_enemy[1]-vec2d[1], vec2d_enemy[0]-vec2d[0]))
-        
-        bearing = (bearing + 360) % 360
-        bearing = (bearing + 90) % 360
-        
-        circle_bearing = (bearing + 90) % 360
-        
-        steering = (circle_bearing - myvalues[td['bearing']]) % 360
-        
-        # Normalize steering to be within -180 to 180 degrees
-        if steering > 180:
-            steering -= 360
-        
-        if abs(steering) >= 15:
-            thrust = 3.0
-        else:
-            thrust = 10.0
+        thrust, steering = Geometry.circle_scalar(bearing, float(myvalues[td['bearing']]))
 
         # print("bearing: ", bearing, " my bearing: ", myvalues[td['bearing']], '  steering: ', steering)
         # print("steering: ", steering * 10)
@@ -148,52 +144,64 @@ class Controller:
         return thrust, steering, bearing
 
     def get_state(self, myvalues, othervalues, bearing, distance_to_enemy, turretbearing, turretdecl, thrust, steering, prev_x_enemy, prev_z_enemy):
-        state = (
-            int((bearing + 0.000000001) // 36),
-            int((distance_to_enemy + 0.000000001) // 100),
-            int(turretbearing // 36),
-            int(turretdecl // 10),
-            int(thrust // 3.33),
-            int(steering // 3),
-            int(myvalues[td['x']] // 100),
-            int(myvalues[td['z']] // 100),
-            int(myvalues[td['bearing']] // 36),
-            int(othervalues[td['x']] // 100),
-            int(othervalues[td['z']] // 100),
-            int(prev_x_enemy - othervalues[td['x']] // 100),
-            int(prev_z_enemy - othervalues[td['z']] // 100),
-            int(othervalues[td['bearing']] // 36)
-        )
-        return state
+        # The state is packed into a single int key, see StateDiscretizer.terminator_spec
+        return self.discretizer.key({
+            'bearing': bearing,
+            'distance': distance_to_enemy,
+            'turretbearing': turretbearing,
+            'turretdecl': turretdecl,
+            'thrust': thrust,
+            'steering': steering,
+            'x': myvalues[td['x']],
+            'z': myvalues[td['z']],
+            'my_bearing': myvalues[td['bearing']],
+            'enemy_x': othervalues[td['x']],
+            'enemy_z': othervalues[td['z']],
+            'enemy_dx': prev_x_enemy - othervalues[td['x']],
+            'enemy_dz': prev_z_enemy - othervalues[td['z']],
+            'enemy_bearing': othervalues[td['bearing']]})
 
     def choose_action(self, state):
+        # Returns the action id, use self.acciones[id] to get the tuple.
         if np.random.rand() < self.epsilon:
-            return random.choice(self.acciones)  # Explorar
-        return max(self.acciones, key=lambda a: self.q_table[state][self.acciones.index(a)])  # Explotar
+            return self.acciones.random_id()  # Explorar
+        return self.q_table.argmax(state)  # Explotar
 
     def update_q_table(self, state, action, reward, next_state):
-        best_next_action = max(self.acciones, key=lambda a: self.q_table[next_state][self.acciones.index(a)])
-        td_target = reward + self.discount_factor * self.q_table[next_state][self.acciones.index(best_next_action)]
-        td_error = td_target - self.q_table[state][self.acciones.index(action)]
-        self.q_table[state][self.acciones.index(action)] += self.learning_rate * td_error
+        td_error = self.q_table.update(state, action, reward, next_state, self.learning_rate, self.discount_factor)
+        self.replay.add(state, action, reward, next_state, td_error)
+        return td_error
+
+    def replay_shots(self):
+        # Minibatches from the replay buffer for the shots resolved since the last tick, within the time budget.
+        return self.replay.replay(self.q_table, self.replay_batch, self.learning_rate, self.discount_factor,
+                                  self.replay_budget, self.replay_ratio)
+
+    def end_episode(self, state):
+        # The shots still in flight get what they did so far, then the table is saved.
+        for shot, reward in self.rewards.clear():
+            self.update_q_table(shot.state, shot.action, reward, state)
+        self.save_q_table()
+
+    def save_q_table(self):
+        # Non blocking, the checkpointer writes it in the background.
+        if self.checkpointer is not None:
+            self.checkpointer.save()
 
     def run(self):
         if self.tank == 1:
-            command = Command('127.0.0.1', 4501)
+            command = CommandChannel('127.0.0.1', 4501)
         else:
-            command = Command('127.0.0.1', 4502)
+            command = CommandChannel('127.0.0.1', 4502)
 
         shouldrun = True
         random_distance = np.random.choice([ 100])#, 400, 500, 600, 700, 800, 900, 1000])
+        timer = self.timer
         while shouldrun:
             try:
-                tank1values = self.read()
-                if int(tank1values[td['number']]) != 1:
-                    continue
-
-                tank2values = self.read()
-                if int(tank2values[td['number']]) != 2:
-                    continue  
+                timer.start()
+                tank1values, tank2values = self.read()
+                timer.lap('wait')
 
                 if self.tank == 1:
                     myvalues = tank1values
@@ -202,95 +210,91 @@ class Controller:
                     myvalues = tank2values
                     othervalues = tank1values
 
-                turretbearing = self.lock_enemigo(myvalues, othervalues)
-                distance_to_enemy = math.sqrt((myvalues[td['x']] - othervalues[td['x']]) ** 2 +
-                                              (myvalues[td['z']] - othervalues[td['z']]) ** 2)
+                enemybearing = self.enemy_bearing(myvalues, othervalues)
+                turretbearing = self.lock_enemigo(myvalues, othervalues, enemybearing)
+                distance_to_enemy = Geometry.distance_scalar(float(myvalues[td['x']]), float(myvalues[td['z']]),
+                                                             float(othervalues[td['x']]), float(othervalues[td['z']]))
                 
-                if distance_to_enemy > 300:
-                    thrust, steering, bearing = self.acercar_enemigo(myvalues, othervalues, command)
+                if distance_to_enemy > Geometry.APPROACH_DISTANCE:
+                    thrust, steering, bearing = self.acercar_enemigo(myvalues, othervalues, command, enemybearing)
 
                 if distance_to_enemy < random_distance:
-                    thrust, steering, bearing = self.circular_enemigo(myvalues, othervalues, command)
+                    thrust, steering, bearing = self.circular_enemigo(myvalues, othervalues, command, enemybearing)
                     
                 # print(f"Time: {myvalues[td['timer']]} Health: {myvalues[td['health']]} Distance to enemy: {distance_to_enemy}")
 
                 state = self.get_state(myvalues, othervalues, bearing, distance_to_enemy, turretbearing, 0, thrust, steering, self.prev_x_enemy, self.prev_z_enemy)
+                timer.lap('state')
                 
-                # Solo permitir disparar si no estamos esperando el resultado de un disparo anterior
-                if not self.waiting_for_result:
-                    disparo, turretdecl, bearing_corr = self.choose_action(state)
-                    
+                action = self.choose_action(state)
+                disparo, turretdecl, bearing_corr = self.acciones[action]
+                
+                fired = -1
+                if disparo == 1 and self.rewards.can_fire():
+                    # The correction only aims this shot, the turret keeps following the enemy.
                     turretbearing += bearing_corr
-                    if disparo == 1:
-                        command.fire()
-                        print(f"turret decl: {turretdecl}, bearing correction: {bearing_corr}")
-                        self.waiting_for_result = True  # Bloquear nuevos disparos
-                        self.delayed_rewards.append({
-                            'state': state,
-                            'action': (disparo, turretdecl, bearing_corr),
-                            'delay': 150,
-                            'health': othervalues[td['health']]# Define un retardo adecuado en pasos de simulación
-                        })
-                        
-                        
+                    command.fire()
+                    fired = action
+                    print(f"turret decl: {turretdecl}, bearing correction: {bearing_corr}")
+                    self.rewards.schedule(myvalues[td['timer']], state, action, othervalues[td['health']],
+                                          window=flight_window(distance_to_enemy, turretdecl))
                 
-                # Manejar recompensas diferidas
-                if self.delayed_rewards:
-                    for reward_item in list(self.delayed_rewards):
-                        reward_item['delay'] -= 1  # Reducir el contador de delay
-                        if reward_item['delay'] <= 0:
-                            # Determina la recompensa basada en el impacto de la bala
-                            current_health = othervalues[td['health']]
-                            if (reward_item['health'] - current_health) > 0:
-                                reward = (reward_item['health'] - current_health) * 20
-                                
-                            else:
-                                reward = -50
-                            print(f"enemy previous health: {reward_item['health']}, current health: {current_health}")
-                            print(f"----------------Reward: {reward}")
-                            self.update_q_table(reward_item['state'], reward_item['action'], reward, state)
-                            self.delayed_rewards.remove(reward_item)
-                            self.waiting_for_result = False  # Liberar el bloqueo de disparo
+                timer.lap('action')
+
+                # Manejar recompensas diferidas, only the shots due at this timer
+                self.rewards.observe(myvalues[td['timer']], othervalues[td['health']])
+                for shot, reward in self.rewards.resolve(myvalues[td['timer']]):
+                    print(f"enemy health when fired: {shot.health}, damage of the shot: {shot.damage}")
+                    print(f"----------------Reward: {reward}")
+                    self.update_q_table(shot.state, shot.action, reward, state)
+
+                timer.lap('update')
 
                 self.previous_enemy_health = othervalues[td['health']]  # Update the previous health
                 self.prev_x_enemy = othervalues[td['x']]
                 self.prev_z_enemy = othervalues[td['z']]
                 
-                self.recorder.recordvalues(myvalues, othervalues, turretdecl, bearing_corr, turretbearing, turretbearing)
+                self.recorder.recordvalues(myvalues, othervalues, turretdecl, bearing_corr, turretbearing, turretbearing, fired)
+                timer.lap('record')
 
                 if (int(othervalues[td['health']]) < 50):
-                    reward = 5000
-                    self.update_q_table(reward_item['state'], reward_item['action'], reward, state)
-                    print(f"Enemy tank destroyed. reward: {reward}")
-                    with open('q_table.pkl', 'wb') as f:
-                        pickle.dump(self.q_table, f)
-                        print("Q-table saved successfully.")
+                    if self.rewards.last is not None:
+                        # Once per episode, to the last shot.
+                        reward = 5000
+                        self.update_q_table(self.rewards.last.state, self.rewards.last.action, reward, state)
+                        print(f"Enemy tank destroyed. reward: {reward}")
+                        self.rewards.last = None
+                    self.end_episode(state)
                     command.command = 13  
                     
                 if (myvalues[td['timer']] > 4900):
-                    with open('q_table.pkl', 'wb') as f:
-                        pickle.dump(self.q_table, f)
-                        print("Q-table saved successfully.")
+                    self.end_episode(state)
                     command.command = 13  
                     
                     
                 if (myvalues[td['power']] < 10):
-                    with open('q_table.pkl', 'wb') as f:
-                        pickle.dump(self.q_table, f)
-                        print("Q-table saved successfully.")
+                    self.end_episode(state)
                     command.command = 13  
                     
+                timer.lap('episode')
                 command.send_command(myvalues[td['timer']], self.tank, thrust,
                                      steering,
                                      turretdecl,
                                      turretbearing)  
+                timer.lap('send')
+                self.replay_shots()
+                timer.lap('replay')
+                timer.tick()
             except socket.timeout:
                 print("Episode Completed")
-                with open('q_table.pkl', 'wb') as f:
-                    pickle.dump(self.q_table, f)
-                    print("Q-table saved successfully.")
+                print("Frames: %d used, %d dropped, %d stale" % (self.receiver.consumed, self.receiver.dropped, self.receiver.stale))
+                timer.close()
+                self.save_q_table()
+                if self.checkpointer is not None:
+                    self.checkpointer.close()
                 break
 
 if __name__ == '__main__':
-    controller = Controller(sys.argv[1])
+    # python terminator.py tank [shared Q-table name]
+    controller = Controller(sys.argv[1], shared=sys.argv[2] if len(sys.argv) >= 3 else None)
     controller.run()
@@ -4,18 +4,19 @@ import datetime, time
 import sys
 import math
 import numpy as np
-import pickle
+import os
 import random
-from collections import defaultdict
 
 from Command import Command
 from Command import Recorder
 from TelemetryDictionary import telemetrydirs as td
+from Protocol import ModelRecord
+from QTable import QTable, load_pickle
+from Checkpointer import Checkpointer
+import QTableFile
+from ActionTable import ActionTable
 
 
-def default_q_value():
-    return np.zeros(len(range(6)) * len(range(-5, 6)))  # Espacio de acciones combinadas
-
 
 class Controller:
     def __init__(self, tankparam, load_q_table=False):
@@ -29,15 +30,14 @@ class Controller:
         self.sock.bind(self.server_address)
         self.sock.settimeout(5)
 
-        self.length = 84
-        self.unpackcode = 'Lififfffffffffffffff'
+        self.length = ModelRecord.size
+        self.unpackcode = ModelRecord.code
 
         self.recorder = Recorder()
         self.tank = tankparam
         self.previous_fire_angle = -3
 
         # Q-learning parameters
-        self.q_table = defaultdict(default_q_value)
         self.learning_rate = 0.1
         self.discount_factor = 0.95
         self.epsilon = 0.1
@@ -47,17 +47,22 @@ class Controller:
         self.prev_z_enemy = 0
 
         # Define the combined action space
-        self.acciones = [(decl, bearing_corr) for decl in range(6) for bearing_corr in range(-5, 6)]
+        self.acciones = ActionTable.grid(range(6), range(-5, 6))
+        self.q_table = QTable(len(self.acciones))
 
         if load_q_table:
-            with open('q_table.pkl', 'rb') as f:
-                self.q_table = pickle.load(f)
-                print("Q-table loaded successfully.")
+            if os.path.exists('q_table.qtab'):
+                self.q_table = QTableFile.load('q_table.qtab')
+            else:
+                self.q_table = load_pickle('q_table.pkl')
+            print("Q-table loaded successfully.")
+
+        self.checkpointer = Checkpointer(self.q_table, 'q_table.qtab')
 
     def read(self):
         data, address = self.sock.recvfrom(self.length)
         if len(data) > 0 and len(data) == self.length:
-            new_values = unpack(self.unpackcode, data)
+            new_values = ModelRecord.unpack(data)
             return new_values
         return None
 
@@ -166,15 +171,17 @@ class Controller:
         return state
 
     def choose_action(self, state):
+        # Returns the action id, use self.acciones[id] to get the tuple.
         if np.random.rand() < self.epsilon:
-            return random.choice(self.acciones)  # Explorar
-        return max(self.acciones, key=lambda a: self.q_table[state][self.acciones.index(a)])  # Explotar
+            return self.acciones.random_id()  # Explorar
+        return self.q_table.argmax(state)  # Explotar
 
     def update_q_table(self, state, action, reward, next_state):
-        best_next_action = max(self.acciones, key=lambda a: self.q_table[next_state][self.acciones.index(a)])
-        td_target = reward + self.discount_factor * self.q_table[next_state][self.acciones.index(best_next_action)]
-        td_error = td_target - self.q_table[state][self.acciones.index(action)]
-        self.q_table[state][self.acciones.index(action)] += self.learning_rate * td_error
+        self.q_table.update(state, action, reward, next_state, self.learning_rate, self.discount_factor)
+
+    def save_q_table(self):
+        # Non blocking, the checkpointer writes it in the background.
+        self.checkpointer.save()
 
     def run(self):
         if self.tank == 1:
@@ -211,7 +218,8 @@ class Controller:
                 state = self.get_state(myvalues, othervalues, bearing, distance_to_enemy, turretbearing, 0, thrust, steering, self.prev_x_enemy, self.prev_z_enemy)
                 
                 # Escoge la acción: combinación de turretdecl y corrección de bearing
-                turretdecl, bearing_corr = self.choose_action(state)
+                action = self.choose_action(state)
+                turretdecl, bearing_corr = self.acciones[action]
 
                 # Aplica la corrección al bearing
                 turretbearing += bearing_corr
@@ -227,7 +235,7 @@ class Controller:
                         reward = -50
 
                 next_state = self.get_state(myvalues, othervalues, bearing, distance_to_enemy, turretbearing, turretdecl, thrust, steering, self.prev_x_enemy, self.prev_z_enemy)
-                self.update_q_table(state, (turretdecl, bearing_corr), reward, next_state)
+                self.update_q_table(state, action, reward, next_state)
 
                 self.previous_enemy_health = current_health  # Update the previous health
                 self.prev_x_enemy = othervalues[td['x']]
@@ -236,22 +244,16 @@ class Controller:
                 self.recorder.recordvalues(myvalues, othervalues, turretdecl, bearing_corr, turretbearing, turretbearing)
 
                 if (int(othervalues[td['health']]) < 50):
-                    with open('q_table.pkl', 'wb') as f:
-                        pickle.dump(self.q_table, f)
-                        print("Q-table saved successfully.")
+                    self.save_q_table()
                     command.command = 13  
                     
                 if (myvalues[td['timer']] > 4000):
-                    with open('q_table.pkl', 'wb') as f:
-                        pickle.dump(self.q_table, f)
-                        print("Q-table saved successfully.")
+                    self.save_q_table()
                     command.command = 13  
                     
                     
                 if (myvalues[td['power']] < 10):
-                    with open('q_table.pkl', 'wb') as f:
-                        pickle.dump(self.q_table, f)
-                        print("Q-table saved successfully.")
+                    self.save_q_table()
                     command.command = 13  
                     
                 command.send_command(myvalues[td['timer']], self.tank, thrust,
@@ -260,9 +262,8 @@ class Controller:
                                      turretbearing)  
             except socket.timeout:
                 print("Episode Completed")
-                with open('q_table.pkl', 'wb') as f:
-                    pickle.dump(self.q_table, f)
-                    print("Q-table saved successfully.")
+                self.save_q_table()
+                self.checkpointer.close()
                 break
 
 if __name__ == '__main__':
@@ -4,13 +4,16 @@ import datetime, time
 import sys
 import math
 import numpy as np
-import pickle
+import os
 import random
-from collections import defaultdict
 
 from Command import Command
 from Command import Recorder
 from TelemetryDictionary import telemetrydirs as td
+from Protocol import ModelRecord
+from QTable import QTable, load_pickle
+from Checkpointer import Checkpointer
+import QTableFile
 
 class Controller:
     def __init__(self, tankparam, load_q_table=False):
@@ -24,28 +27,32 @@ class Controller:
         self.sock.bind(self.server_address)
         self.sock.settimeout(5)
 
-        self.length = 84
-        self.unpackcode = 'Lififfffffffffffffff'
+        self.length = ModelRecord.size
+        self.unpackcode = ModelRecord.code
 
         self.recorder = Recorder()
         self.tank = tankparam
         self.previous_fire_angle = -3
 
-        self.q_table = defaultdict(lambda: np.zeros(2))
+        self.q_table = QTable(2)
         self.learning_rate = 0.1
         self.discount_factor = 0.95
         self.epsilon = 0.1
         self.previous_enemy_health = None
 
         if load_q_table:
-            with open('q_table.pkl', 'rb') as f:
-                self.q_table = pickle.load(f)
-                print("Q-table loaded successfully.")
+            if os.path.exists('q_table.qtab'):
+                self.q_table = QTableFile.load('q_table.qtab')
+            else:
+                self.q_table = load_pickle('q_table.pkl')
+            print("Q-table loaded successfully.")
+
+        self.checkpointer = Checkpointer(self.q_table, 'q_table.qtab')
 
     def read(self):
         data, address = self.sock.recvfrom(self.length)
         if len(data) > 0 and len(data) == self.length:
-            new_values = unpack(self.unpackcode, data)
+            new_values = ModelRecord.unpack(data)
             return new_values
         return None
 
@@ -145,13 +152,14 @@ class Controller:
     def choose_action(self, state):
         if np.random.rand() < self.epsilon:
             return np.random.choice([0, 1])  # Explorar
-        return np.argmax(self.q_table[state])  # Explotar
+        return self.q_table.argmax(state)  # Explotar
 
     def update_q_table(self, state, action, reward, next_state):
-        best_next_action = np.argmax(self.q_table[next_state])
-        td_target = reward + self.discount_factor * self.q_table[next_state][best_next_action]
-        td_error = td_target - self.q_table[state][action]
-        self.q_table[state][action] += self.learning_rate * td_error
+        self.q_table.update(state, action, reward, next_state, self.learning_rate, self.discount_factor)
+
+    def save_q_table(self):
+        # Non blocking, the checkpointer writes it in the background.
+        self.checkpointer.save()
 
     def run(self):
         if self.tank == 1:
@@ -220,10 +228,8 @@ class Controller:
                 print("Episode Completed")
                 
 
-                with open('q_table.pkl', 'wb') as f:
-                    pickle.dump(self.q_table, f)
-                    print("Q-table saved successfully.")
-                    
+                self.save_q_table()
+                self.checkpointer.close()
                 break
 
 if __name__ == '__main__':